@@ -10,6 +10,7 @@ from stable_baselines3.common.env_util import make_vec_env
 from stable_baselines3.common.callbacks import EvalCallback
 
 import src
+from src.envs import ViZDoomVecEnv
 
 ENV_NAME = "ViZDoomCorridor-v0"
 MODEL_NAME = "ppo_vizdoom_corridor"
@@ -25,7 +26,6 @@ class ObservationWrapper(gym.ObservationWrapper):
         super().__init__(env)
         self.image_shape = shape
         self.image_shape_reverse = shape[::-1]
-        self.env.frame_skip = FRAME_SKIP
 
         num_channels = env.observation_space.shape[2]
         new_shape = (shape[0], shape[1], num_channels)
@@ -33,7 +33,8 @@ class ObservationWrapper(gym.ObservationWrapper):
 
     def observation(self, observation):
         observation = cv2.resize(observation, self.image_shape_reverse, interpolation=cv2.INTER_AREA)
-        return observation
+        # cv2 drops the channel axis of single channel images
+        return observation.reshape(self.observation_space.shape)
 
 
 def wrap_env(env):
@@ -44,8 +45,10 @@ def wrap_env(env):
 
 def main():
     learn = False
-    train_envs = make_vec_env(ENV_NAME, n_envs=N_ENVS, wrapper_class=wrap_env)
-    val_envs = make_vec_env(ENV_NAME, n_envs=N_ENVS, wrapper_class=wrap_env)
+    train_envs = make_vec_env(ENV_NAME, n_envs=N_ENVS, wrapper_class=wrap_env,
+                              env_kwargs={"frame_skip": FRAME_SKIP}, vec_env_cls=ViZDoomVecEnv)
+    val_envs = make_vec_env(ENV_NAME, n_envs=N_ENVS, wrapper_class=wrap_env,
+                            env_kwargs={"frame_skip": FRAME_SKIP}, vec_env_cls=ViZDoomVecEnv)
     if learn:
         agent = PPO("CnnPolicy", train_envs, verbose=1, n_steps=N_STEPS, learning_rate=1e-4, batch_size=128,
                     tensorboard_log="logs")
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+#####################################################################
+# Throughput benchmark of the registered ViZDoom environments.
+# Runs every env headless with random actions over a sweep of frame
+# skips, screen resolutions, enabled buffers and process counts, and
+# writes steps/s, frames/s, p50/p99 step latency and the peak RSS of
+# every process to a JSON file to compare versions against.
+#####################################################################
+
+import json
+import multiprocessing as mp
+import os
+import platform
+import resource
+from argparse import ArgumentParser
+from itertools import product
+from threading import BrokenBarrierError
+from time import perf_counter_ns, strftime
+
+import gymnasium as gym
+import numpy as np
+import vizdoom
+
+import src
+
+# buffer overrides of ViZDoomEnv, "config" keeps what the config file enables
+BUFFER_SETS = {
+    "config": {},
+    "none": dict(depth_buffer=False, labels_buffer=False, automap_buffer=False),
+    "depth": dict(depth_buffer=True, labels_buffer=False, automap_buffer=False),
+    "labels": dict(depth_buffer=False, labels_buffer=True, automap_buffer=False),
+    "automap": dict(depth_buffer=False, labels_buffer=False, automap_buffer=True),
+    "all": dict(depth_buffer=True, labels_buffer=True, automap_buffer=True),
+}
+
+
+def run_worker(env_id, env_kwargs, steps, warmup, seed, barrier, queue):
+    """Steps one env with random actions and sends back its step latencies, run time and peak RSS"""
+    try:
+        env = gym.make(env_id, disable_env_checker=True, **env_kwargs)
+        env.reset(seed=seed)
+        actions = np.random.default_rng(seed).integers(env.action_space.n, size=warmup + steps)
+        latencies = np.empty(steps, dtype=np.int64)
+
+        for action in actions[:warmup]:
+            _, _, terminated, truncated, _ = env.step(action)
+            if terminated or truncated:
+                env.reset()
+
+        # all processes start timing together, so their steps overlap like in a vector env
+        barrier.wait()
+        start = perf_counter_ns()
+        for i, action in enumerate(actions[warmup:]):
+            step_start = perf_counter_ns()
+            _, _, terminated, truncated, _ = env.step(action)
+            if terminated or truncated:
+                # the reset is part of the step that ends the episode, as in a vector env
+                env.reset()
+            latencies[i] = perf_counter_ns() - step_start
+        elapsed = perf_counter_ns() - start
+
+        env.close()
+        # ru_maxrss is in kilobytes on Linux
+        rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        queue.put({"latencies": latencies, "elapsed": elapsed, "rss_mb": rss_mb})
+    except BrokenBarrierError:
+        queue.put({"error": "another process failed"})
+    except Exception as e:
+        barrier.abort()
+        queue.put({"error": repr(e)})
+
+
+def benchmark(env_id, frame_skip, resolution, buffers, processes, steps, warmup):
+    """Runs the env in `processes` processes at once and summarizes their steps"""
+    ctx = mp.get_context("spawn")
+    barrier = ctx.Barrier(processes)
+    queue = ctx.Queue()
+    env_kwargs = dict(frame_skip=frame_skip, **BUFFER_SETS[buffers])
+    if resolution != "config":
+        env_kwargs["screen_resolution"] = resolution
+
+    workers = [
+        ctx.Process(target=run_worker, args=(env_id, env_kwargs, steps, warmup, seed, barrier, queue))
+        for seed in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    results = [queue.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+
+    result = {
+        "env": env_id,
+        "frame_skip": frame_skip,
+        "resolution": resolution,
+        "buffers": buffers,
+        "processes": processes,
+    }
+    errors = [r["error"] for r in results if "error" in r]
+    if errors:
+        result["error"] = errors[0]
+        return result
+
+    latencies_ms = np.concatenate([r["latencies"] for r in results]) / 1e6
+    steps_per_second = sum(steps / (r["elapsed"] / 1e9) for r in results)
+    result.update(
+        steps_per_second=steps_per_second,
+        frames_per_second=steps_per_second * frame_skip,
+        p50_latency_ms=float(np.percentile(latencies_ms, 50)),
+        p99_latency_ms=float(np.percentile(latencies_ms, 99)),
+        rss_mb=[r["rss_mb"] for r in results],
+    )
+    return result
+
+
+if __name__ == "__main__":
+    registered = sorted(env_id for env_id in gym.registry if env_id.startswith("ViZDoom"))
+
+    parser = ArgumentParser("Throughput benchmark of the registered ViZDoom environments.")
+    parser.add_argument("--envs", nargs="+", default=registered, help="Env ids to benchmark.")
+    parser.add_argument("--frame-skips", nargs="+", type=int, default=[1, 4], help="Frame skips to sweep.")
+    parser.add_argument("--resolutions", nargs="+", default=["config", "RES_160X120"],
+                        help="ScreenResolution names to sweep, 'config' uses the config file.")
+    parser.add_argument("--buffers", nargs="+", default=["config", "none", "all"], choices=list(BUFFER_SETS),
+                        help="Buffer sets to sweep.")
+    parser.add_argument("--processes", nargs="+", type=int, default=[1, 4], help="Process counts to sweep.")
+    parser.add_argument("--steps", type=int, default=500, help="Timed steps per process.")
+    parser.add_argument("--warmup", type=int, default=50, help="Untimed steps per process.")
+    parser.add_argument("--output", default="benchmark_envs.json", help="JSON file to write the results to.")
+    args = parser.parse_args()
+
+    results = []
+    for env_id, frame_skip, resolution, buffers, processes in product(
+            args.envs, args.frame_skips, args.resolutions, args.buffers, args.processes):
+        result = benchmark(env_id, frame_skip, resolution, buffers, processes, args.steps, args.warmup)
+        results.append(result)
+        setting = f"{env_id} frame_skip={frame_skip} resolution={resolution} buffers={buffers} processes={processes}"
+        if "error" in result:
+            print(f"{setting}: failed with {result['error']}")
+        else:
+            print(f"{setting}: {result['steps_per_second']:.0f} steps/s, {result['frames_per_second']:.0f} frames/s, "
+                  f"p50 {result['p50_latency_ms']:.2f} ms, p99 {result['p99_latency_ms']:.2f} ms, "
+                  f"RSS {max(result['rss_mb']):.0f} MB")
+
+    report = {
+        "date": strftime("%Y-%m-%dT%H:%M:%S"),
+        "vizdoom": vizdoom.__version__,
+        "numpy": np.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "steps": args.steps,
+        "warmup": args.warmup,
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print("Results written to", args.output)
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+#####################################################################
+# Micro-benchmark of the frame preprocessing used by main.py.
+# Compares the FramePreprocessor modes against the original
+# skimage.transform.resize based preprocess() on GRAY8 frames, one
+# frame at a time and in batches.
+#####################################################################
+
+from argparse import ArgumentParser
+from time import perf_counter
+
+import numpy as np
+import skimage.transform
+
+from main import FramePreprocessor, resolution
+
+
+def legacy_preprocess(img):
+    """The original preprocess() of main.py"""
+    img = skimage.transform.resize(img, resolution)
+    img = img.astype(np.float32)
+    img = np.expand_dims(img, axis=0)
+    return img
+
+
+def time_per_frame(fn, n_frames, repeats):
+    fn()
+    best = float("inf")
+    for _ in range(repeats):
+        start = perf_counter()
+        fn()
+        best = min(best, perf_counter() - start)
+    return best / n_frames
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser("Benchmark of the frame preprocessing of main.py.")
+    parser.add_argument("--height", type=int, default=480, help="Input frame height.")
+    parser.add_argument("--width", type=int, default=640, help="Input frame width.")
+    parser.add_argument("--batch-size", type=int, default=64, help="Frames per batch.")
+    parser.add_argument("--repeats", type=int, default=20, help="Timed repetitions.")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    frames = rng.integers(0, 256, (args.batch_size, args.height, args.width), dtype=np.uint8)
+    reference = np.stack([legacy_preprocess(frame) for frame in frames])
+
+    legacy = time_per_frame(
+        lambda: [legacy_preprocess(frame) for frame in frames], len(frames), args.repeats
+    )
+    print("Input {}x{}, output {}x{}".format(args.height, args.width, *resolution))
+    print("{:<24}{:>12}{:>10}{:>14}".format("method", "us/frame", "speedup", "mean |diff|"))
+    print("{:<24}{:>12.1f}{:>10.1f}{:>14.4f}".format("legacy preprocess", legacy * 1e6, 1.0, 0.0))
+
+    for mode in ("skimage", "area", "stride"):
+        preprocessor = FramePreprocessor(resolution, mode)
+        out = np.empty((1, *resolution), dtype=np.float32)
+        batch_out = np.empty((len(frames), 1, *resolution), dtype=np.float32)
+
+        single = time_per_frame(
+            lambda: [preprocessor(frame, out) for frame in frames], len(frames), args.repeats
+        )
+        batched = time_per_frame(
+            lambda: preprocessor.batch(frames, batch_out), len(frames), args.repeats
+        )
+        diff = np.abs(preprocessor.batch(frames) - reference).mean()
+
+        for name, t in (("single", single), ("batch", batched)):
+            print(
+                "{:<24}{:>12.1f}{:>10.1f}{:>14.4f}".format(
+                    "{} ({})".format(mode, name), t * 1e6, legacy / t, diff
+                )
+            )
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+#####################################################################
+# Benchmark of the DQN and A2C updates without the emulator.
+# Feeds synthetic replay (DQNAgent.train of main.py) and rollout
+# (A2C.get_losses/update_parameters) data of realistic shapes and
+# measures updates/s, sampling time, host-to-device copy time and
+# peak memory over a sweep of batch sizes and torch thread counts.
+# Every setting runs in its own process, so the peaks are its own.
+#####################################################################
+
+import json
+import multiprocessing as mp
+import os
+import platform
+import resource
+from argparse import ArgumentParser
+from itertools import product
+from time import perf_counter, strftime
+
+import numpy as np
+import torch
+
+
+def peak_memory():
+    """Peak RSS of this process and peak CUDA allocation in MB"""
+    # ru_maxrss is in kilobytes on Linux
+    memory = {"peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+    if torch.cuda.is_available():
+        memory["peak_cuda_mb"] = torch.cuda.max_memory_allocated() / 2 ** 20
+    return memory
+
+
+def bench_dqn(batch_size, args):
+    """Times DQNAgent.train on a replay memory filled with random transitions of the main.py state shape"""
+    import main
+
+    agent = main.DQNAgent(
+        args["actions"],
+        memory_size=args["memory_size"],
+        batch_size=batch_size,
+        discount_factor=main.discount_factor,
+        lr=main.learning_rate,
+        load_model=False,
+        frame_history=args["frame_history"],
+        replay_mode=args["replay_mode"],
+    )
+    rng = np.random.default_rng(0)
+    state_shape = (args["frame_history"], *main.resolution)
+
+    def random_frame():
+        return rng.integers(0, 256, main.resolution).astype(np.float32) / 255
+
+    # a sequential stream of episodes like train_epoch produces, so the frame replay can deduplicate the frames
+    history = main.FrameHistory(args["frame_history"], main.resolution)
+    state = history.reset(random_frame())
+    for _ in range(args["memory_size"]):
+        done = rng.random() < 0.01
+        next_state = np.zeros_like(state) if done else history.push(random_frame())
+        agent.append_memory(state, rng.integers(args["actions"]), rng.random(), next_state, done)
+        state = history.reset(random_frame()) if done else next_state
+
+    def time_ms(fn, repeats):
+        fn()
+        start = perf_counter()
+        for _ in range(repeats):
+            fn()
+        return (perf_counter() - start) / repeats * 1e3
+
+    batch = agent.memory.sample(batch_size)
+    sample_ms = time_ms(lambda: agent.memory.sample(batch_size), args["updates"])
+    h2d_ms = time_ms(
+        lambda: (torch.from_numpy(batch[0]).to(main.DEVICE), torch.from_numpy(batch[3]).to(main.DEVICE)),
+        args["updates"],
+    )
+    for _ in range(args["warmup"]):
+        agent.train()
+    update_ms = time_ms(agent.train, args["updates"])
+    return {
+        "updates_per_second": 1e3 / update_ms,
+        "update_ms": update_ms,
+        "sample_ms": sample_ms,
+        "h2d_ms": h2d_ms,
+        "state_shape": [batch_size, *state_shape],
+    }
+
+
+def bench_a2c(n_envs, args):
+    """Times A2C rollouts of synthetic uint8 observations and the get_losses/update_parameters that follow"""
+    from src.algorithms import A2C, RolloutStorage
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    shape = tuple(args["a2c_shape"])
+    n_steps = args["a2c_steps"]
+    agent = A2C(args["a2c_features"], args["actions"], device, 5e-4, 1e-4, n_envs,
+                observation_shape=shape, fused=args["fused"])
+    storage = RolloutStorage(n_steps, n_envs, device)
+
+    rng = np.random.default_rng(0)
+    observations = rng.integers(0, 256, (n_steps, n_envs, *shape), dtype=np.uint8)
+    rewards = torch.from_numpy(rng.random((n_steps, n_envs), dtype=np.float32))
+    masks = torch.from_numpy(rng.random((n_steps, n_envs)) > 0.01)
+
+    rollout_time = h2d_time = update_time = 0.0
+    for update in range(args["warmup"] + args["updates"]):
+        start = perf_counter()
+        storage.reset()
+        for t in range(n_steps):
+            copy_start = perf_counter()
+            x = torch.from_numpy(observations[t]).to(device)
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            copy_end = perf_counter()
+            _, action_log_probs, state_values, entropy = agent.select_action(x)
+            storage.insert(rewards[t], action_log_probs, state_values, entropy, masks[t])
+            if update >= args["warmup"]:
+                h2d_time += copy_end - copy_start
+
+        update_start = perf_counter()
+        critic_loss, actor_loss = agent.get_losses(storage.rewards, storage.action_log_probs, storage.value_preds,
+                                                   storage.entropy, storage.masks, 0.99, 0.95, 0.01, device)
+        agent.update_parameters(critic_loss, actor_loss)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        end = perf_counter()
+        if update >= args["warmup"]:
+            rollout_time += update_start - start
+            update_time += end - update_start
+
+    updates = args["updates"]
+    return {
+        "updates_per_second": updates / (rollout_time + update_time),
+        "update_ms": update_time / updates * 1e3,
+        "rollout_ms": rollout_time / updates * 1e3,
+        "h2d_ms": h2d_time / (updates * n_steps) * 1e3,
+        "rollout_shape": [n_steps, n_envs],
+        "observation_shape": list(shape),
+    }
+
+
+def run_setting(algo, batch_size, threads, args, queue):
+    torch.set_num_threads(threads)
+    try:
+        result = bench_dqn(batch_size, args) if algo == "dqn" else bench_a2c(batch_size, args)
+        result.update(peak_memory())
+    except Exception as e:
+        result = {"error": repr(e)}
+    queue.put(result)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser("Benchmark of the DQN and A2C updates on synthetic data.")
+    parser.add_argument("--algos", nargs="+", default=["dqn", "a2c"], choices=["dqn", "a2c"],
+                        help="Algorithms to benchmark.")
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[32, 64, 128],
+                        help="DQN minibatch sizes, for A2C the number of envs per rollout.")
+    parser.add_argument("--threads", nargs="+", type=int, default=[1, 2, 4], help="torch.set_num_threads values.")
+    parser.add_argument("--updates", type=int, default=50, help="Timed updates per setting.")
+    parser.add_argument("--warmup", type=int, default=5, help="Untimed updates per setting.")
+    parser.add_argument("--actions", type=int, default=8, help="Number of actions.")
+    parser.add_argument("--memory-size", type=int, default=10000, help="DQN replay memory size.")
+    parser.add_argument("--frame-history", type=int, default=1, help="DQN frames per state.")
+    parser.add_argument("--replay-mode", default="transitions", choices=["transitions", "frames"],
+                        help="DQN replay memory mode.")
+    parser.add_argument("--a2c-shape", nargs=3, type=int, default=[60, 80, 8], metavar=("H", "W", "C"),
+                        help="A2C observation shape.")
+    parser.add_argument("--a2c-steps", type=int, default=32, help="A2C steps per rollout.")
+    parser.add_argument("--a2c-features", type=int, default=256, help="A2C encoder features.")
+    parser.add_argument("--fused", action="store_true", help="Use the fused A2C update.")
+    parser.add_argument("--output", default="benchmark_training.json", help="JSON file to write the results to.")
+    args = parser.parse_args()
+
+    ctx = mp.get_context("spawn")
+    results = []
+    for algo, batch_size, threads in product(args.algos, args.batch_sizes, args.threads):
+        queue = ctx.Queue()
+        process = ctx.Process(target=run_setting, args=(algo, batch_size, threads, vars(args), queue))
+        process.start()
+        result = {"algo": algo, "batch_size": batch_size, "threads": threads, **queue.get()}
+        process.join()
+        results.append(result)
+
+        setting = f"{algo} batch_size={batch_size} threads={threads}"
+        if "error" in result:
+            print(f"{setting}: failed with {result['error']}")
+        else:
+            sampling = f"sample {result['sample_ms']:.2f} ms" if algo == "dqn" else \
+                f"rollout {result['rollout_ms']:.2f} ms"
+            print(f"{setting}: {result['updates_per_second']:.1f} updates/s, update {result['update_ms']:.2f} ms, "
+                  f"{sampling}, h2d {result['h2d_ms']:.3f} ms, peak RSS {result['peak_rss_mb']:.0f} MB")
+
+    report = {
+        "date": strftime("%Y-%m-%dT%H:%M:%S"),
+        "torch": torch.__version__,
+        "numpy": np.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "cuda": torch.cuda.is_available(),
+        "settings": vars(args),
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print("Results written to", args.output)
@@ -3,10 +3,12 @@
 # E. Culurciello, L. Mueller, Z. Boztoprak
 # December 2020
 
+import copy
 import itertools as it
+import multiprocessing as mp
 import os
-import random
-from collections import deque
+import shutil
+import threading
 from time import sleep, time
 
 import numpy as np
@@ -25,19 +27,48 @@ discount_factor = 0.99
 train_epochs = 5
 learning_steps_per_epoch = 200
 replay_memory_size = 10000
+# "transitions" keeps (state, next_state) pairs, "frames" stores every frame once as uint8
+replay_memory_mode = "transitions"
+# Number of consecutive frames stacked into one state
+frame_history = 1
+# Prioritized experience replay, see https://arxiv.org/abs/1511.05952
+prioritized_replay = False
+priority_alpha = 0.6
+priority_beta = 0.4
+
+# Number of games stepped in lockstep by worker processes during training (1 = no workers)
+num_envs = 1
 
 # NN learning settings
 batch_size = 64
+# updates_per_step gradient updates every train_every steps (a step of every game with num_envs > 1)
+train_every = 1
+updates_per_step = 1
+# Train in a background thread while acting instead, syncing the acting network every learner_sync_every updates
+async_learner = False
+learner_sync_every = 100
+# at most this many learner updates per transition appended to the replay memory, None for no limit
+learner_replay_ratio = updates_per_step / train_every
 
 # Training regime
 test_episodes_per_epoch = 10
+# Number of worker processes playing the test episodes (0 = test on the training game)
+num_eval_workers = 0
+# Let the workers test an epoch while the next one trains, its results are printed afterwards
+concurrent_eval = True
 
 # Other parameters
 frame_repeat = 12
 resolution = (30, 45)
+# "area" averages pixels, "stride" subsamples them, "skimage" uses skimage.transform.resize
+preprocess_mode = "area"
+# None renders at the smallest ScreenResolution that covers resolution
+screen_resolution = None
 episodes_to_watch = 10
 
 model_savefile = "./model-doom.pth"
+# Directory the replay memory is snapshotted to with every save and reopened from on load (None = no snapshot)
+replay_snapshot_dir = None
 save_model = True
 load_model = False
 skip_learning = False
@@ -55,87 +86,445 @@ else:
     DEVICE = torch.device("cpu")
 
 
+class FramePreprocessor:
+    """
+    Down samples GRAY8 frames to size and scales them to [0, 1] float32.
+    "area" averages the input pixels that fall into each output pixel, "stride" takes
+    the pixel closest to the center of each output pixel and "skimage" is the
+    anti-aliased skimage.transform.resize. The bins are computed once per input shape,
+    rows are summed with a reshape when the input height is a multiple of the output
+    height, a batch of frames is processed in one call and the result can be written
+    into a preallocated output buffer.
+    """
+
+    def __init__(self, size, mode="area"):
+        if mode not in ("area", "stride", "skimage"):
+            raise ValueError("Unknown preprocess mode: {}".format(mode))
+        self.size = size
+        self.mode = mode
+        self._bins = {}
+
+    def _get_bins(self, shape):
+        if shape not in self._bins:
+            (h, w), (H, W) = self.size, shape
+            if self.mode == "area":
+                rows, cols = np.arange(h) * H // h, np.arange(w) * W // w
+                counts = np.outer(np.diff(rows, append=H), np.diff(cols, append=W))
+                scale = (1.0 / (255.0 * counts)).astype(np.float32)
+                if H % h == 0:
+                    rows = H // h
+                self._bins[shape] = rows, cols, scale
+            else:
+                rows = ((np.arange(h) + 0.5) * H / h).astype(np.intp)
+                cols = ((np.arange(w) + 0.5) * W / w).astype(np.intp)
+                self._bins[shape] = rows, cols, np.float32(1 / 255)
+        return self._bins[shape]
+
+    def batch(self, imgs, out=None):
+        """Down samples frames of shape (N, H, W) into an array of shape (N, 1, *size)"""
+        if out is None:
+            out = np.empty((len(imgs), 1, *self.size), dtype=np.float32)
+        if self.mode == "skimage":
+            for img, o in zip(imgs, out):
+                o[0] = skimage.transform.resize(img, self.size)
+            return out
+
+        rows, cols, scale = self._get_bins(imgs.shape[1:])
+        if self.mode == "area":
+            if isinstance(rows, int):
+                sums = imgs.reshape(len(imgs), -1, rows, imgs.shape[2])
+                sums = sums.sum(axis=2, dtype=np.uint16 if rows <= 257 else np.uint32)
+            else:
+                sums = np.add.reduceat(imgs, rows, axis=1, dtype=np.uint32)
+            sums = np.add.reduceat(sums, cols, axis=2, dtype=np.float32)
+        else:
+            sums = imgs[:, rows[:, np.newaxis], cols]
+        np.multiply(sums, scale, out=out[:, 0])
+        return out
+
+    def __call__(self, img, out=None):
+        """Down samples one frame of shape (H, W) into an array of shape (1, *size)"""
+        if out is None:
+            out = np.empty((1, *self.size), dtype=np.float32)
+        self.batch(img[np.newaxis], out[np.newaxis])
+        return out
+
+
+preprocessor = FramePreprocessor(resolution, preprocess_mode)
+
+
 def preprocess(img):
     """Down samples image to resolution"""
-    img = skimage.transform.resize(img, resolution)
-    img = img.astype(np.float32)
-    img = np.expand_dims(img, axis=0)
-    return img
+    return preprocessor(img)
+
 
+class FrameHistory:
+    """
+    Keeps the last `length` preprocessed frames of the current episode as one state.
+    Frames from before the start of the episode are zeros, the same padding
+    FrameReplayMemory applies when it stacks frames at sample time.
+    """
 
-def create_simple_game():
+    def __init__(self, length, frame_shape):
+        self.frames = np.zeros((length, *frame_shape), dtype=np.float32)
+
+    def reset(self, frame):
+        self.frames[:-1] = 0
+        self.frames[-1] = frame
+        return self.frames.copy()
+
+    def push(self, frame):
+        self.frames[:-1] = self.frames[1:]
+        self.frames[-1] = frame
+        return self.frames.copy()
+
+
+def smallest_screen_resolution(height, width):
+    """Returns the ScreenResolution with the fewest pixels that is at least height x width"""
+    covering = []
+    for name, screen_res in vzd.ScreenResolution.__members__.items():
+        res_width, res_height = map(int, name[len("RES_") :].split("X"))
+        if res_width >= width and res_height >= height:
+            covering.append((res_width * res_height, screen_res))
+    return min(covering, key=lambda c: c[0])[1]
+
+
+def measure_steps_per_second(game, steps=100):
+    """Times no-op make_action/get_state steps of frame_repeat tics and starts a new episode"""
+    noop = [0] * game.get_available_buttons_size()
+    game.new_episode()
+    start = time()
+    for _ in range(steps):
+        if game.is_episode_finished():
+            game.new_episode()
+        game.make_action(noop, frame_repeat)
+        game.get_state()
+    steps_per_second = steps / (time() - start)
+    game.new_episode()
+    return steps_per_second
+
+
+def create_simple_game(measure_speed=True):
     print("Initializing doom...")
     game = vzd.DoomGame()
     game.load_config(config_file_path)
     game.set_window_visible(False)
     game.set_mode(vzd.Mode.PLAYER)
     game.set_screen_format(vzd.ScreenFormat.GRAY8)
-    game.set_screen_resolution(vzd.ScreenResolution.RES_640X480)
+    if screen_resolution is None:
+        game.set_screen_resolution(smallest_screen_resolution(*resolution))
+    else:
+        game.set_screen_resolution(screen_resolution)
     game.init()
     print("Doom initialized.")
 
+    if measure_speed:
+        print(
+            "Screen resolution: {}x{}, {:.1f} steps/s".format(
+                game.get_screen_width(),
+                game.get_screen_height(),
+                measure_steps_per_second(game),
+            )
+        )
+
     return game
 
 
+class WorkerPool:
+    """
+    Starts one spawned worker process per pipe, running target(remote, *args), and
+    closes them again. The workers answer commands sent over their pipes until "close"
+    """
+
+    def __init__(self, target, num_workers, *args):
+        ctx = mp.get_context("spawn")
+        self.remotes, work_remotes = zip(*[ctx.Pipe() for _ in range(num_workers)])
+        self.processes = []
+        for work_remote in work_remotes:
+            process = ctx.Process(target=target, args=(work_remote, *args), daemon=True)
+            process.start()
+            work_remote.close()
+            self.processes.append(process)
+
+    def close(self):
+        for remote in self.remotes:
+            remote.send(("close", None))
+        for process in self.processes:
+            process.join()
+
+
+def _game_worker(remote, actions, frame_repeat, frame_history):
+    """Steps one DoomGame on behalf of DoomGamePool and sends back preprocessed states"""
+    game = create_simple_game(measure_speed=False)
+    history = FrameHistory(frame_history, resolution)
+    try:
+        while True:
+            cmd, data = remote.recv()
+            if cmd == "step":
+                reward = game.make_action(actions[data], frame_repeat)
+                done = game.is_episode_finished()
+                score = None
+                if not done:
+                    next_state = state = history.push(
+                        preprocess(game.get_state().screen_buffer)
+                    )
+                else:
+                    next_state = np.zeros_like(history.frames)
+                    score = game.get_total_reward()
+                    game.new_episode()
+                    state = history.reset(preprocess(game.get_state().screen_buffer))
+                remote.send((next_state, reward, done, score, state))
+            elif cmd == "reset":
+                game.new_episode()
+                remote.send(history.reset(preprocess(game.get_state().screen_buffer)))
+            elif cmd == "close":
+                break
+    finally:
+        game.close()
+        remote.close()
+
+
+class DoomGamePool(WorkerPool):
+    """
+    Runs num_games DoomGame instances in worker processes and steps them in lockstep.
+    Workers preprocess their own frames, so only the small states cross the pipes,
+    and finished episodes are restarted right away.
+    """
+
+    def __init__(self, num_games, actions, frame_repeat, frame_history):
+        super().__init__(_game_worker, num_games, actions, frame_repeat, frame_history)
+        self.num_games = num_games
+
+    def reset(self):
+        """Starts a new episode in every game and returns the batch of first states"""
+        for remote in self.remotes:
+            remote.send(("reset", None))
+        return np.stack([remote.recv() for remote in self.remotes])
+
+    def step(self, action_indices):
+        """
+        Makes one action in every game.
+        Returns (next_states, rewards, dones, scores, states), where scores holds the total
+        rewards of the finished episodes and states are the states to act on next.
+        """
+        for remote, action in zip(self.remotes, action_indices):
+            remote.send(("step", int(action)))
+        next_states, rewards, dones, scores, states = zip(
+            *[remote.recv() for remote in self.remotes]
+        )
+        return (
+            np.stack(next_states),
+            np.array(rewards, dtype=np.float32),
+            np.array(dones),
+            [score for score in scores if score is not None],
+            np.stack(states),
+        )
+
+
+def _eval_worker(remote, actions, frame_repeat, frame_history):
+    """Plays test episodes with a frozen copy of q_net on behalf of EvaluationPool"""
+    torch.set_num_threads(1)
+    game = create_simple_game(measure_speed=False)
+    q_net = DuelQNet(len(actions), frame_history).eval()
+    history = FrameHistory(frame_history, resolution)
+    try:
+        while True:
+            cmd, data = remote.recv()
+            if cmd == "evaluate":
+                state_dict, epsilon, episodes = data
+                q_net.load_state_dict(
+                    {name: torch.from_numpy(value) for name, value in state_dict.items()}
+                )
+                scores = []
+                for _ in range(episodes):
+                    game.new_episode()
+                    state = history.reset(preprocess(game.get_state().screen_buffer))
+                    while not game.is_episode_finished():
+                        if np.random.uniform() < epsilon:
+                            action = np.random.randint(len(actions))
+                        else:
+                            with torch.inference_mode():
+                                q_values = q_net(torch.from_numpy(state[None]))
+                            action = torch.argmax(q_values).item()
+
+                        game.make_action(actions[action], frame_repeat)
+                        if not game.is_episode_finished():
+                            state = history.push(
+                                preprocess(game.get_state().screen_buffer)
+                            )
+                    scores.append(game.get_total_reward())
+                remote.send(scores)
+            elif cmd == "close":
+                break
+    finally:
+        game.close()
+        remote.close()
+
+
+class EvaluationPool(WorkerPool):
+    """
+    Plays test episodes in worker processes, each with its own DoomGame and CPU copy
+    of q_net. submit() sends a snapshot of the weights and returns right away, so an
+    evaluation can run while the next epoch trains, results() waits for its scores.
+    """
+
+    def __init__(self, num_workers, actions, frame_repeat, frame_history):
+        super().__init__(_eval_worker, num_workers, actions, frame_repeat, frame_history)
+        self.num_workers = num_workers
+        self.pending = False
+
+    def submit(self, q_net, epsilon, episodes):
+        """Starts playing episodes with the current weights of q_net, split over the workers"""
+        # NumPy copies, tensors would be moved to shared memory and keep training
+        state_dict = {
+            name: value.detach().cpu().numpy() for name, value in q_net.state_dict().items()
+        }
+        for i, remote in enumerate(self.remotes):
+            worker_episodes = episodes // self.num_workers + (i < episodes % self.num_workers)
+            remote.send(("evaluate", (state_dict, epsilon, worker_episodes)))
+        self.pending = True
+
+    def results(self):
+        """Waits for the submitted episodes and returns their scores"""
+        scores = [score for remote in self.remotes for score in remote.recv()]
+        self.pending = False
+        return np.array(scores)
+
+
+def print_test_results(test_scores):
+    print(
+        "Results: mean: {:.1f} +/- {:.1f},".format(
+            test_scores.mean(), test_scores.std()
+        ),
+        "min: %.1f" % test_scores.min(),
+        "max: %.1f" % test_scores.max(),
+    )
+
+
 def test(game, agent):
     """Runs a test_episodes_per_epoch episodes and prints the result"""
     print("\nTesting...")
     test_scores = []
+    history = FrameHistory(agent.frame_history, resolution)
     for test_episode in trange(test_episodes_per_epoch, leave=False):
         game.new_episode()
+        state = history.reset(preprocess(game.get_state().screen_buffer))
         while not game.is_episode_finished():
-            state = preprocess(game.get_state().screen_buffer)
             best_action_index = agent.get_action(state)
 
             game.make_action(actions[best_action_index], frame_repeat)
+            if not game.is_episode_finished():
+                state = history.push(preprocess(game.get_state().screen_buffer))
         r = game.get_total_reward()
         test_scores.append(r)
 
-    test_scores = np.array(test_scores)
-    print(
-        "Results: mean: {:.1f} +/- {:.1f},".format(
-            test_scores.mean(), test_scores.std()
-        ),
-        "min: %.1f" % test_scores.min(),
-        "max: %.1f" % test_scores.max(),
-    )
+    print_test_results(np.array(test_scores))
+
+
+def train_epoch(game, agent, actions, frame_repeat, steps_per_epoch):
+    """Plays steps_per_epoch training steps on game and returns the finished episode scores"""
+    history = FrameHistory(agent.frame_history, resolution)
+    game.new_episode()
+    state = history.reset(preprocess(game.get_state().screen_buffer))
+    train_scores = []
+    global_step = 0
 
+    for _ in trange(steps_per_epoch, leave=False):
+        action = agent.get_action(state)
+        reward = game.make_action(actions[action], frame_repeat)
+        done = game.is_episode_finished()
 
-def run(game, agent, actions, num_epochs, frame_repeat, steps_per_epoch=2000):
+        if not done:
+            next_state = history.push(preprocess(game.get_state().screen_buffer))
+        else:
+            next_state = np.zeros_like(state)
+
+        agent.append_memory(state, action, reward, next_state, done)
+
+        if global_step > agent.batch_size:
+            agent.decay_epsilon()
+            agent.train_on_schedule(global_step)
+
+        if done:
+            train_scores.append(game.get_total_reward())
+            game.new_episode()
+            next_state = history.reset(preprocess(game.get_state().screen_buffer))
+
+        state = next_state
+        global_step += 1
+
+    return train_scores
+
+
+def train_epoch_vectorized(pool, agent, steps_per_epoch):
+    """
+    Plays steps_per_epoch training steps spread over the games of pool, acting on all
+    of them with one batched forward pass, and returns the finished episode scores
+    """
+    states = pool.reset()
+    train_scores = []
+    global_step = 0
+
+    for step in trange(-(-steps_per_epoch // pool.num_games), leave=False):
+        actions = agent.get_action(states)
+        next_states, rewards, dones, scores, states_after = pool.step(actions)
+        agent.append_memory_batch(states, actions, rewards, next_states, dones)
+
+        if global_step > agent.batch_size:
+            agent.decay_epsilon(pool.num_games)
+            agent.train_on_schedule(step)
+
+        train_scores.extend(scores)
+        states = states_after
+        global_step += pool.num_games
+
+    return train_scores
+
+
+def run(
+    game,
+    agent,
+    actions,
+    num_epochs,
+    frame_repeat,
+    steps_per_epoch=2000,
+    num_envs=1,
+    num_eval_workers=0,
+    concurrent_eval=True,
+):
     """
     Run num epochs of training episodes.
     Skip frame_repeat number of frames after each action.
+    With num_envs > 1 the training steps are played on num_envs games in worker
+    processes, while game is still used for testing.
+    With agent.async_learner the agent trains in a background thread during each
+    training epoch.
+    With num_eval_workers > 0 the test episodes are played by an EvaluationPool,
+    with concurrent_eval while the next epoch trains.
     """
 
     start_time = time()
+    pool = None
+    if num_envs > 1:
+        pool = DoomGamePool(num_envs, actions, frame_repeat, agent.frame_history)
+    eval_pool = None
+    if num_eval_workers > 0:
+        eval_pool = EvaluationPool(
+            num_eval_workers, actions, frame_repeat, agent.frame_history
+        )
 
     for epoch in range(num_epochs):
-        game.new_episode()
-        train_scores = []
-        global_step = 0
         print("\nEpoch #" + str(epoch + 1))
-
-        for _ in trange(steps_per_epoch, leave=False):
-            state = preprocess(game.get_state().screen_buffer)
-            action = agent.get_action(state)
-            reward = game.make_action(actions[action], frame_repeat)
-            done = game.is_episode_finished()
-
-            if not done:
-                next_state = preprocess(game.get_state().screen_buffer)
-            else:
-                next_state = np.zeros((1, 30, 45)).astype(np.float32)
-
-            agent.append_memory(state, action, reward, next_state, done)
-
-            if global_step > agent.batch_size:
-                agent.train()
-
-            if done:
-                train_scores.append(game.get_total_reward())
-                game.new_episode()
-
-            global_step += 1
+        if agent.async_learner:
+            agent.start_learner()
+        if pool is not None:
+            train_scores = train_epoch_vectorized(pool, agent, steps_per_epoch)
+        else:
+            train_scores = train_epoch(
+                game, agent, actions, frame_repeat, steps_per_epoch
+            )
+        if agent.async_learner:
+            agent.stop_learner()
 
         agent.update_target_net()
         train_scores = np.array(train_scores)
@@ -148,12 +537,28 @@ def run(game, agent, actions, num_epochs, frame_repeat, steps_per_epoch=2000):
             "max: %.1f," % train_scores.max(),
         )
 
-        test(game, agent)
+        if eval_pool is None:
+            test(game, agent)
+        else:
+            if eval_pool.pending:
+                print("\nTest results of epoch #" + str(epoch))
+                print_test_results(eval_pool.results())
+            print("\nTesting...")
+            eval_pool.submit(agent.q_net, agent.epsilon, test_episodes_per_epoch)
+            if not concurrent_eval:
+                print_test_results(eval_pool.results())
         if save_model:
             print("Saving the network weights to:", model_savefile)
-            torch.save(agent.q_net, model_savefile)
+            agent.save_checkpoint(model_savefile, replay_snapshot_dir)
         print("Total elapsed time: %.2f minutes" % ((time() - start_time) / 60.0))
 
+    if pool is not None:
+        pool.close()
+    if eval_pool is not None:
+        if eval_pool.pending:
+            print("\nTest results of epoch #" + str(num_epochs))
+            print_test_results(eval_pool.results())
+        eval_pool.close()
     game.close()
     return agent, game
 
@@ -164,10 +569,10 @@ class DuelQNet(nn.Module):
     see https://arxiv.org/abs/1511.06581 for more information.
     """
 
-    def __init__(self, available_actions_count):
+    def __init__(self, available_actions_count, in_channels=1):
         super().__init__()
         self.conv1 = nn.Sequential(
-            nn.Conv2d(1, 8, kernel_size=3, stride=2, bias=False),
+            nn.Conv2d(in_channels, 8, kernel_size=3, stride=2, bias=False),
             nn.BatchNorm2d(8),
             nn.ReLU(),
         )
@@ -213,6 +618,344 @@ class DuelQNet(nn.Module):
         return x
 
 
+class ReplayMemory:
+    """
+    Fixed-size ring buffer of transitions.
+    Every field lives in one preallocated NumPy array and a write cursor wraps around
+    once the buffer is full, so appending never allocates and a minibatch is a single
+    fancy-index gather per field.
+    """
+
+    snapshot_fields = ("states", "actions", "rewards", "next_states", "dones", "pos", "size")
+
+    def __init__(self, capacity, state_shape, state_dtype=np.float32):
+        self.capacity = int(capacity)
+        self.states = np.zeros((self.capacity, *state_shape), dtype=state_dtype)
+        self.actions = np.zeros(self.capacity, dtype=np.int64)
+        self.rewards = np.zeros(self.capacity, dtype=np.float32)
+        self.next_states = np.zeros((self.capacity, *state_shape), dtype=state_dtype)
+        self.dones = np.zeros(self.capacity, dtype=np.bool_)
+        self.pos = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, state, action, reward, next_state, done):
+        i = self.pos
+        self.states[i] = state
+        self.actions[i] = action
+        self.rewards[i] = reward
+        self.next_states[i] = next_state
+        self.dones[i] = done
+
+        self.pos = (i + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def extend(self, states, actions, rewards, next_states, dones):
+        """Appends a batch of transitions"""
+        n = len(actions)
+        idx = (self.pos + np.arange(n)) % self.capacity
+        self.states[idx] = states
+        self.actions[idx] = actions
+        self.rewards[idx] = rewards
+        self.next_states[idx] = next_states
+        self.dones[idx] = dones
+
+        self.pos = (self.pos + n) % self.capacity
+        self.size = min(self.size + n, self.capacity)
+
+    def is_valid(self, idx):
+        return idx < self.size
+
+    def sample(self, batch_size):
+        """Returns (states, actions, rewards, next_states, dones) of uniformly drawn transitions"""
+        return self.gather(np.random.randint(0, self.size, size=batch_size))
+
+    def gather(self, idx):
+        return (
+            self.states[idx],
+            self.actions[idx],
+            self.rewards[idx],
+            self.next_states[idx],
+            self.dones[idx],
+        )
+
+
+class FrameReplayMemory:
+    """
+    Replay memory that keeps every observed frame once, as uint8, indexed by step.
+    The next state of a transition is rebuilt from the following slot, so only the
+    newest frame of each appended state is stored. Episode boundaries are tracked with
+    per-slot flags and states of history_length > 1 are stacked at sample time, with
+    frames from before the start of an episode zero-padded like FrameHistory does.
+    With streams > 1 every extend() call holds one step of each of `streams` games and
+    the slots of a game are interleaved, so its next slot is `streams` slots ahead.
+    """
+
+    snapshot_fields = (
+        "frames",
+        "actions",
+        "rewards",
+        "dones",
+        "starts",
+        "_next_frames",
+        "_episode_ended",
+        "pos",
+        "size",
+    )
+
+    def __init__(self, capacity, frame_shape, history_length=1, streams=1):
+        self.streams = streams
+        self.capacity = int(capacity) // streams * streams
+        self.history_length = history_length
+        self.frames = np.zeros((self.capacity, *frame_shape), dtype=np.uint8)
+        self.actions = np.zeros(self.capacity, dtype=np.int64)
+        self.rewards = np.zeros(self.capacity, dtype=np.float32)
+        self.dones = np.zeros(self.capacity, dtype=np.bool_)  # transition ends an episode
+        self.starts = np.zeros(self.capacity, dtype=np.bool_)  # frame begins an episode
+        self.pos = 0
+        self.size = 0
+
+        # frames the next appended states have to match to continue the current episodes
+        self._next_frames = np.zeros((streams, *frame_shape), dtype=np.uint8)
+        self._episode_ended = np.ones(streams, dtype=np.bool_)
+
+    def __len__(self):
+        return self.size
+
+    @staticmethod
+    def _quantize(frames, out):
+        if frames.dtype == np.uint8:
+            out[...] = frames
+        else:
+            np.copyto(out, np.rint(frames * 255), casting="unsafe")
+
+    def append(self, state, action, reward, next_state, done):
+        self.extend(
+            state[np.newaxis],
+            np.array([action]),
+            np.array([reward]),
+            next_state[np.newaxis],
+            np.array([done]),
+        )
+
+    def extend(self, states, actions, rewards, next_states, dones):
+        """Appends one transition of every stream"""
+        rows = slice(self.pos, self.pos + self.streams)
+        frames = self.frames[rows]
+        self._quantize(states[:, -1], frames)
+        # a state that does not continue the previous transition (e.g. after new_episode()
+        # was called without a terminal step) starts a new episode as well
+        self.starts[rows] = self._episode_ended | np.any(
+            frames != self._next_frames, axis=tuple(range(1, frames.ndim))
+        )
+        self.actions[rows] = actions
+        self.rewards[rows] = rewards
+        self.dones[rows] = dones
+
+        self._episode_ended[:] = dones
+        self._quantize(next_states[:, -1], self._next_frames)
+
+        self.pos = (self.pos + self.streams) % self.capacity
+        self.size = min(self.size + self.streams, self.capacity)
+
+    def is_valid(self, idx):
+        """Transitions whose next frame is stored and whose frame stack is complete"""
+        age = (idx - self.pos) % self.capacity // self.streams
+        newest = age == self.capacity // self.streams - 1
+        valid = self.dones[idx] | (
+            ~newest & ~self.starts[(idx + self.streams) % self.capacity]
+        )
+        if self.size == self.capacity and self.history_length > 1:
+            # the stacks of the oldest slots would reach across the cursor into new frames
+            valid &= age >= self.history_length - 1
+        return valid
+
+    def _stack(self, idx):
+        k = self.history_length
+        if k == 1:
+            return self.frames[idx][:, np.newaxis]
+
+        offsets = np.arange(1 - k, 1) * self.streams
+        slots = (idx[:, np.newaxis] + offsets) % self.capacity
+        states = self.frames[slots]
+        # drop every frame followed by an episode start within the stack
+        started = np.logical_or.accumulate(self.starts[slots][:, ::-1], axis=1)[:, ::-1]
+        states[:, :-1][started[:, 1:]] = 0
+        return states
+
+    def sample(self, batch_size):
+        """Returns (states, actions, rewards, next_states, dones) of uniformly drawn transitions"""
+        idx = np.random.randint(0, self.size, size=batch_size)
+        invalid = ~self.is_valid(idx)
+        while invalid.any():
+            idx[invalid] = np.random.randint(0, self.size, size=invalid.sum())
+            invalid[invalid] = ~self.is_valid(idx[invalid])
+        return self.gather(idx)
+
+    def gather(self, idx):
+        scale = np.float32(1 / 255)
+        states = np.multiply(self._stack(idx), scale, dtype=np.float32)
+        next_states = np.multiply(
+            self._stack((idx + self.streams) % self.capacity), scale, dtype=np.float32
+        )
+        return states, self.actions[idx], self.rewards[idx], next_states, self.dones[idx]
+
+
+class SumTree:
+    """
+    Array-backed binary tree whose inner nodes hold the sum of their two children.
+    The root sits at index 1 and leaf i at index leaves + i, so sampling by prefix sum
+    and priority updates are O(log n) and run for a whole batch at once.
+    """
+
+    snapshot_fields = ("tree",)
+
+    def __init__(self, capacity):
+        self.leaves = 1 << (int(capacity) - 1).bit_length()
+        self.depth = self.leaves.bit_length() - 1
+        self.tree = np.zeros(2 * self.leaves, dtype=np.float64)
+
+    @property
+    def total(self):
+        return self.tree[1]
+
+    def get(self, idx):
+        return self.tree[idx + self.leaves]
+
+    def update(self, idx, priorities):
+        pos = idx + self.leaves
+        self.tree[pos] = priorities
+        for _ in range(self.depth):
+            pos = pos // 2
+            self.tree[pos] = self.tree[2 * pos] + self.tree[2 * pos + 1]
+
+    def find(self, values):
+        """Returns the leaves at which the prefix sums of the priorities reach values"""
+        pos = np.ones(len(values), dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2 * pos
+            left_sum = self.tree[left]
+            go_right = values >= left_sum
+            values = np.where(go_right, values - left_sum, values)
+            pos = left + go_right
+        return pos - self.leaves
+
+
+class PrioritizedReplayMemory:
+    """
+    Proportional prioritized replay (https://arxiv.org/abs/1511.05952) over a replay memory.
+    New transitions get the highest priority seen so far, sample() draws one transition
+    per equal-mass segment of the sum-tree and returns importance-sampling weights, and
+    update_priorities() writes back the TD errors of a whole minibatch.
+    """
+
+    snapshot_fields = ("memory", "tree", "beta", "max_priority")
+
+    def __init__(self, memory, alpha=0.6, beta=0.4, beta_steps=100000, eps=1e-6):
+        self.memory = memory
+        self.tree = SumTree(memory.capacity)
+        self.alpha = alpha
+        self.beta = beta
+        self.beta_increment = (1.0 - beta) / beta_steps
+        self.eps = eps
+        self.max_priority = 1.0
+
+    def __len__(self):
+        return len(self.memory)
+
+    @property
+    def capacity(self):
+        return self.memory.capacity
+
+    def append(self, state, action, reward, next_state, done):
+        idx = np.array([self.memory.pos])
+        self.memory.append(state, action, reward, next_state, done)
+        self.tree.update(idx, self.max_priority)
+
+    def extend(self, states, actions, rewards, next_states, dones):
+        idx = (self.memory.pos + np.arange(len(actions))) % self.capacity
+        self.memory.extend(states, actions, rewards, next_states, dones)
+        self.tree.update(idx, self.max_priority)
+
+    def is_valid(self, idx):
+        return (self.tree.get(idx) > 0) & self.memory.is_valid(idx)
+
+    def sample(self, batch_size):
+        """Returns (batch, indices, importance-sampling weights)"""
+        total = self.tree.total
+        segment = total / batch_size
+        values = (np.arange(batch_size) + np.random.uniform(size=batch_size)) * segment
+        idx = self.tree.find(values)
+        invalid = ~self.is_valid(idx)
+        while invalid.any():
+            idx[invalid] = self.tree.find(np.random.uniform(0, total, size=invalid.sum()))
+            invalid[invalid] = ~self.is_valid(idx[invalid])
+
+        probs = self.tree.get(idx) / total
+        weights = (len(self) * probs) ** -self.beta
+        weights /= weights.max()
+        self.beta = min(1.0, self.beta + self.beta_increment)
+
+        return self.memory.gather(idx), idx, weights.astype(np.float32)
+
+    def update_priorities(self, idx, td_errors):
+        priorities = (np.abs(td_errors) + self.eps) ** self.alpha
+        self.tree.update(idx, priorities)
+        self.max_priority = max(self.max_priority, priorities.max())
+
+
+def _snapshot_items(obj, prefix=""):
+    """Yields (file name, owner, attribute) for the snapshot_fields of a replay memory and its parts"""
+    for name in obj.snapshot_fields:
+        value = getattr(obj, name)
+        if hasattr(value, "snapshot_fields"):
+            yield from _snapshot_items(value, prefix + name + ".")
+        else:
+            yield prefix + name + ".npy", obj, name
+
+
+def save_replay_snapshot(memory, directory):
+    """
+    Writes the replay memory to directory, one .npy file per array or counter.
+    The snapshot is written next to the old one and swapped in afterwards, so an
+    interrupted save never leaves a half-written snapshot behind
+    """
+    tmp_directory, old_directory = directory + ".tmp", directory + ".old"
+    shutil.rmtree(tmp_directory, ignore_errors=True)
+    os.makedirs(tmp_directory)
+    for filename, obj, name in _snapshot_items(memory):
+        np.save(os.path.join(tmp_directory, filename), getattr(obj, name))
+
+    shutil.rmtree(old_directory, ignore_errors=True)
+    if os.path.exists(directory):
+        os.replace(directory, old_directory)
+    os.replace(tmp_directory, directory)
+    shutil.rmtree(old_directory, ignore_errors=True)
+
+
+def load_replay_snapshot(memory, directory):
+    """
+    Reopens a snapshot written by save_replay_snapshot into memory, which has to be
+    configured like the saved one. The arrays are memory-mapped copy-on-write, so they
+    are paged in as they are sampled and new transitions never modify the files
+    """
+    for filename, obj, name in _snapshot_items(memory):
+        value = np.load(os.path.join(directory, filename), mmap_mode="c")
+        if value.ndim == 0:
+            setattr(obj, name, value.item())
+            continue
+        expected = getattr(obj, name)
+        if value.shape != expected.shape or value.dtype != expected.dtype:
+            raise ValueError(
+                "Snapshot {} has shape {} and dtype {}, the memory expects {} and {}".format(
+                    filename, value.shape, value.dtype, expected.shape, expected.dtype
+                )
+            )
+        setattr(obj, name, value.view(np.ndarray))
+
+
 class DQNAgent:
     def __init__(
         self,
@@ -225,6 +968,20 @@ class DQNAgent:
         epsilon=1,
         epsilon_decay=0.9996,
         epsilon_min=0.1,
+        frame_shape=resolution,
+        frame_history=1,
+        replay_mode="transitions",
+        prioritized=False,
+        priority_alpha=0.6,
+        priority_beta=0.4,
+        priority_beta_steps=100000,
+        num_envs=1,
+        replay_snapshot_dir=None,
+        train_every=1,
+        updates_per_step=1,
+        async_learner=False,
+        learner_sync_every=100,
+        learner_replay_ratio=None,
     ):
         self.action_size = action_size
         self.epsilon = epsilon
@@ -233,77 +990,228 @@ class DQNAgent:
         self.batch_size = batch_size
         self.discount = discount_factor
         self.lr = lr
-        self.memory = deque(maxlen=memory_size)
+        self.frame_history = frame_history
+        if replay_mode == "frames":
+            self.memory = FrameReplayMemory(
+                memory_size, frame_shape, frame_history, streams=num_envs
+            )
+        elif replay_mode == "transitions":
+            self.memory = ReplayMemory(memory_size, (frame_history, *frame_shape))
+        else:
+            raise ValueError("Unknown replay mode: {}".format(replay_mode))
+        self.prioritized = prioritized
+        if prioritized:
+            self.memory = PrioritizedReplayMemory(
+                self.memory, priority_alpha, priority_beta, priority_beta_steps
+            )
         self.criterion = nn.MSELoss()
 
+        self.q_net = DuelQNet(action_size, frame_history).to(DEVICE)
+        self.target_net = DuelQNet(action_size, frame_history).to(DEVICE)
+        self.opt = optim.SGD(self.q_net.parameters(), lr=self.lr)
+
         if load_model:
             print("Loading model from: ", model_savefile)
-            self.q_net = torch.load(model_savefile)
-            self.target_net = torch.load(model_savefile)
-            self.epsilon = self.epsilon_min
-
+            self.load_checkpoint(model_savefile, replay_snapshot_dir)
         else:
             print("Initializing new model")
-            self.q_net = DuelQNet(action_size).to(DEVICE)
-            self.target_net = DuelQNet(action_size).to(DEVICE)
-
-        self.opt = optim.SGD(self.q_net.parameters(), lr=self.lr)
+        self.action_input = None
+
+        self.train_every = train_every
+        self.updates_per_step = updates_per_step
+        # the async learner trains q_net while actions come from act_net, a copy synced
+        # every learner_sync_every updates, without the learner q_net is used directly
+        self.async_learner = async_learner
+        self.learner_sync_every = learner_sync_every
+        # the learner waits for new transitions once it has made learner_replay_ratio updates per transition
+        self.learner_replay_ratio = learner_replay_ratio
+        self.appended = 0
+        self.act_net = self.q_net
+        self.act_lock = threading.Lock()
+        self.memory_lock = threading.Lock()
+        self.learner = None
+        self.learner_stop = threading.Event()
+        self.learner_error = None
 
     def get_action(self, state):
-        if np.random.uniform() < self.epsilon:
-            return random.choice(range(self.action_size))
-        else:
-            state = np.expand_dims(state, axis=0)
-            state = torch.from_numpy(state).float().to(DEVICE)
-            action = torch.argmax(self.q_net(state)).item()
-            return action
+        if state.ndim == 4:
+            return self.get_actions(state)
+        return int(self.get_actions(state[None])[0])
+
+    def get_actions(self, states):
+        """Returns an epsilon-greedy action for each state of a batch"""
+        actions = np.random.randint(self.action_size, size=len(states))
+        greedy = np.flatnonzero(np.random.uniform(size=len(states)) >= self.epsilon)
+        if len(greedy) > 0:
+            if len(greedy) < len(states):
+                states = states[greedy]
+            actions[greedy] = self.greedy_actions(states)
+        return actions
+
+    def greedy_actions(self, states):
+        """
+        Returns the greedy actions for a batch of states. The states are copied into a
+        persistent float32 input tensor on the device and q_net is evaluated under
+        inference mode with eval-mode BatchNorm, so acting does not touch its statistics
+        """
+        n = len(states)
+        if self.action_input is None or len(self.action_input) < n:
+            self.action_input = torch.empty(
+                (n, *states.shape[1:]), dtype=torch.float32, device=DEVICE
+            )
+        inputs = self.action_input[:n]
+        inputs.copy_(torch.from_numpy(states))
+
+        with self.act_lock:
+            self.act_net.eval()
+            with torch.inference_mode():
+                actions = torch.argmax(self.act_net(inputs), dim=1).cpu().numpy()
+            self.act_net.train()
+        return actions
 
     def update_target_net(self):
         self.target_net.load_state_dict(self.q_net.state_dict())
 
+    def save_checkpoint(self, path, replay_dir=None):
+        """
+        Saves the state_dicts of both networks and the optimizer and epsilon to path,
+        through a temporary file that replaces the old checkpoint only once it is complete.
+        With replay_dir the replay memory is snapshotted as well
+        """
+        checkpoint = {
+            "q_net": self.q_net.state_dict(),
+            "target_net": self.target_net.state_dict(),
+            "optimizer": self.opt.state_dict(),
+            "epsilon": self.epsilon,
+        }
+        torch.save(checkpoint, path + ".tmp")
+        os.replace(path + ".tmp", path)
+        if replay_dir is not None:
+            save_replay_snapshot(self.memory, replay_dir)
+
+    def load_checkpoint(self, path, replay_dir=None):
+        """
+        Restores a checkpoint written by save_checkpoint and, if replay_dir holds a
+        snapshot, the replay memory. Files with a whole pickled q_net are still read
+        """
+        checkpoint = torch.load(path, map_location=DEVICE, weights_only=False)
+        if isinstance(checkpoint, nn.Module):
+            self.q_net.load_state_dict(checkpoint.state_dict())
+            self.target_net.load_state_dict(checkpoint.state_dict())
+            self.epsilon = self.epsilon_min
+        else:
+            self.q_net.load_state_dict(checkpoint["q_net"])
+            self.target_net.load_state_dict(checkpoint["target_net"])
+            self.opt.load_state_dict(checkpoint["optimizer"])
+            self.epsilon = checkpoint["epsilon"]
+
+        if replay_dir is not None and os.path.isdir(replay_dir):
+            print("Loading replay memory from: ", replay_dir)
+            load_replay_snapshot(self.memory, replay_dir)
+
+    def decay_epsilon(self, steps=1):
+        """Decays epsilon once per game step, so exploration follows the acting and not the updates"""
+        self.epsilon = max(self.epsilon * self.epsilon_decay**steps, self.epsilon_min)
+
     def append_memory(self, state, action, reward, next_state, done):
-        self.memory.append((state, action, reward, next_state, done))
+        with self.memory_lock:
+            self.memory.append(state, action, reward, next_state, done)
+            self.appended += 1
+
+    def append_memory_batch(self, states, actions, rewards, next_states, dones):
+        with self.memory_lock:
+            self.memory.extend(states, actions, rewards, next_states, dones)
+            self.appended += len(states)
+
+    def train_on_schedule(self, step):
+        """Runs updates_per_step updates every train_every steps, unless the async learner is training"""
+        if self.learner is None and step % self.train_every == 0:
+            for _ in range(self.updates_per_step):
+                self.train()
+
+    def sync_act_net(self):
+        if self.act_net is not self.q_net:
+            with self.act_lock:
+                self.act_net.load_state_dict(self.q_net.state_dict())
+
+    def start_learner(self):
+        """Starts a thread that trains on the replay memory until stop_learner() is called"""
+        if self.act_net is self.q_net:
+            self.act_net = copy.deepcopy(self.q_net)
+        self.learner_stop.clear()
+        self.learner = threading.Thread(target=self._learn, daemon=True)
+        self.learner.start()
+
+    def stop_learner(self):
+        """Stops the learner thread and syncs the acting network with the trained weights"""
+        self.learner_stop.set()
+        self.learner.join()
+        self.learner = None
+        self.sync_act_net()
+        if self.learner_error is not None:
+            error, self.learner_error = self.learner_error, None
+            raise error
+
+    def _learn(self):
+        updates = 0
+        appended_at_start = self.appended
+        try:
+            while not self.learner_stop.is_set():
+                ahead = (
+                    self.learner_replay_ratio is not None
+                    and updates >= self.learner_replay_ratio * (self.appended - appended_at_start)
+                )
+                if len(self.memory) <= self.batch_size or ahead:
+                    sleep(0.001)
+                    continue
+                self.train()
+                updates += 1
+                if updates % self.learner_sync_every == 0:
+                    self.sync_act_net()
+        except BaseException as error:
+            self.learner_error = error
 
     def train(self):
-        batch = random.sample(self.memory, self.batch_size)
-        batch = np.array(batch, dtype=object)
-
-        states = np.stack(batch[:, 0]).astype(float)
-        actions = batch[:, 1].astype(int)
-        rewards = batch[:, 2].astype(float)
-        next_states = np.stack(batch[:, 3]).astype(float)
-        dones = batch[:, 4].astype(bool)
-        not_dones = ~dones
+        with self.memory_lock:
+            if self.prioritized:
+                batch, batch_idx, weights = self.memory.sample(self.batch_size)
+            else:
+                batch = self.memory.sample(self.batch_size)
+        states, actions, rewards, next_states, dones = batch
 
-        row_idx = np.arange(self.batch_size)  # used for indexing the batch
+        # the replay memories return float32 states and rewards, everything below stays on the device
+        states = torch.from_numpy(states).to(DEVICE)
+        actions = torch.from_numpy(actions).to(DEVICE)
+        rewards = torch.from_numpy(rewards).to(DEVICE)
+        next_states = torch.from_numpy(next_states).to(DEVICE)
+        not_dones = torch.from_numpy(~dones).to(DEVICE)
 
         # value of the next states with double q learning
         # see https://arxiv.org/abs/1509.06461 for more information on double q learning
         with torch.no_grad():
-            next_states = torch.from_numpy(next_states).float().to(DEVICE)
-            idx = row_idx, np.argmax(self.q_net(next_states).cpu().data.numpy(), 1)
-            next_state_values = self.target_net(next_states).cpu().data.numpy()[idx]
-            next_state_values = next_state_values[not_dones]
+            next_actions = torch.argmax(self.q_net(next_states), dim=1, keepdim=True)
+            next_state_values = self.target_net(next_states).gather(1, next_actions).squeeze(1)
 
-        # this defines y = r + discount * max_a q(s', a)
-        q_targets = rewards.copy()
-        q_targets[not_dones] += self.discount * next_state_values
-        q_targets = torch.from_numpy(q_targets).float().to(DEVICE)
+            # this defines y = r + discount * q_target(s', argmax_a q(s', a)), without the second term for terminal s'
+            q_targets = rewards + self.discount * not_dones * next_state_values
 
         # this selects only the q values of the actions taken
-        idx = row_idx, actions
-        states = torch.from_numpy(states).float().to(DEVICE)
-        action_values = self.q_net(states)[idx].float().to(DEVICE)
+        action_values = self.q_net(states).gather(1, actions.unsqueeze(1)).squeeze(1)
 
         self.opt.zero_grad()
-        td_error = self.criterion(q_targets, action_values)
+        if self.prioritized:
+            # importance-sampling weights correct the bias of the non-uniform sampling
+            errors = q_targets - action_values
+            weights = torch.from_numpy(weights).to(DEVICE)
+            td_error = (weights * errors.pow(2)).mean()
+        else:
+            td_error = self.criterion(q_targets, action_values)
         td_error.backward()
         self.opt.step()
 
-        if self.epsilon > self.epsilon_min:
-            self.epsilon *= self.epsilon_decay
-        else:
-            self.epsilon = self.epsilon_min
+        if self.prioritized:
+            with self.memory_lock:
+                self.memory.update_priorities(batch_idx, errors.detach().cpu().numpy())
 
 
 if __name__ == "__main__":
@@ -320,6 +1228,19 @@ if __name__ == "__main__":
         memory_size=replay_memory_size,
         discount_factor=discount_factor,
         load_model=load_model,
+        frame_history=frame_history,
+        replay_mode=replay_memory_mode,
+        prioritized=prioritized_replay,
+        priority_alpha=priority_alpha,
+        priority_beta=priority_beta,
+        priority_beta_steps=train_epochs * learning_steps_per_epoch,
+        num_envs=num_envs,
+        replay_snapshot_dir=replay_snapshot_dir,
+        train_every=train_every,
+        updates_per_step=updates_per_step,
+        async_learner=async_learner,
+        learner_sync_every=learner_sync_every,
+        learner_replay_ratio=learner_replay_ratio,
     )
 
     # Run the training for the set number of epochs
@@ -331,21 +1252,26 @@ if __name__ == "__main__":
             num_epochs=train_epochs,
             frame_repeat=frame_repeat,
             steps_per_epoch=learning_steps_per_epoch,
+            num_envs=num_envs,
+            num_eval_workers=num_eval_workers,
+            concurrent_eval=concurrent_eval,
         )
 
         print("======================================")
         print("Training finished. It's time to watch!")
 
-    # Reinitialize the game with window visible
+    # Reinitialize the game with window visible, at full size instead of the reduced training resolution
     game.close()
     game.set_window_visible(True)
     game.set_mode(vzd.Mode.ASYNC_PLAYER)
+    game.set_screen_resolution(vzd.ScreenResolution.RES_640X480)
     game.init()
 
     for _ in range(episodes_to_watch):
         game.new_episode()
+        history = FrameHistory(agent.frame_history, resolution)
         while not game.is_episode_finished():
-            state = preprocess(game.get_state().screen_buffer)
+            state = history.push(preprocess(game.get_state().screen_buffer))
             best_action_index = agent.get_action(state)
 
             # Instead of make_action(a, frame_repeat) in order to make the animation smooth
@@ -1 +1,2 @@
-from .a2c import A2C
+from .a2c import A2C, compute_gae
+from .rollout import RolloutStorage
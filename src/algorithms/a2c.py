@@ -1,21 +1,116 @@
+from typing import Optional
+
 import torch
 import numpy as np
 import torch.nn as nn
 import torch.optim as optim
 
 
+def compute_gae(
+        rewards: torch.Tensor,
+        value_preds: torch.Tensor,
+        masks: torch.Tensor,
+        gamma: float,
+        lam: float,
+        chunk_size: int = 16,
+) -> torch.Tensor:
+    """
+    Computes the Generalized Advantage Estimation (https://arxiv.org/abs/1506.02438) of a rollout
+    without a Python loop over the time steps.
+
+    The recursion gae[t] = delta[t] + gamma * lam * masks[t] * gae[t + 1] is unrolled into
+    gae[t] = sum_{l >= t} w[t, l] * delta[l] with w[t, l] = prod_{t <= j < l} gamma * lam * masks[j].
+    The weights are cumulative products of the decays, so masks (including zeros) are handled exactly. To keep the
+    weight tensor small, the rollout is split into chunks of chunk_size steps that are solved in one batched matrix
+    product and then chained from the last chunk to the first. As there is no value prediction after the last step,
+    its advantage is zero.
+
+    Args:
+        rewards: A tensor with the rewards for each time step, with shape [n_steps_per_update, n_envs].
+        value_preds: A tensor with the state value predictions for each time step, with shape [n_steps_per_update, n_envs].
+        masks: A tensor with the masks for each time step, with shape [n_steps_per_update, n_envs].
+        gamma: The discount factor.
+        lam: The GAE hyperparameter.
+        chunk_size: The number of time steps solved at once.
+
+    Returns:
+        advantages: A tensor with the advantages, with shape [n_steps_per_update, n_envs].
+    """
+    last = torch.zeros_like(value_preds[-1:])
+    T = len(rewards) - 1
+    if T < 1:
+        return last
+
+    deltas = rewards[:-1] + gamma * masks[:-1] * value_preds[1:] - value_preds[:-1]
+    decays = gamma * lam * masks[:-1]
+
+    # pad to whole chunks, the zero decays of the padding end the recursion there
+    chunk_size = min(chunk_size, T)
+    padding = -T % chunk_size
+    deltas = torch.cat([deltas, deltas.new_zeros(padding, deltas.shape[1])]).unflatten(0, (-1, chunk_size))
+    decays = torch.cat([decays, decays.new_zeros(padding, decays.shape[1])]).unflatten(0, (-1, chunk_size))
+
+    # weights[c, t, l] = prod_{t <= j < l} decays[c, j] for l >= t, a cumulative product along l of the
+    # decays shifted by one step, with the factors for l <= t set to one and the weights for l < t to zero
+    steps = torch.arange(chunk_size, device=deltas.device)
+    later = (steps[None, :] > steps[:, None])[..., None]
+    shifted = torch.cat([torch.ones_like(decays[:, :1]), decays[:, :-1]], dim=1)
+    weights = torch.cumprod(torch.where(later, shifted[:, None], 1.0), dim=2)
+    weights = weights * (steps[None, :] >= steps[:, None])[..., None]
+    advantages = torch.einsum("ctln,cln->ctn", weights, deltas)
+
+    # decay from each step to the first step of the next chunk, then chain the chunks backwards
+    carry = weights[:, :, -1] * decays[:, -1:]
+    chunks = [advantages[-1]]
+    for c in reversed(range(len(advantages) - 1)):
+        chunks.append(advantages[c] + carry[c] * chunks[-1][0])
+    return torch.cat([torch.cat(chunks[::-1])[:T], last])
+
+
+def compute_gae_reference(
+        rewards: torch.Tensor,
+        value_preds: torch.Tensor,
+        masks: torch.Tensor,
+        gamma: float,
+        lam: float,
+) -> torch.Tensor:
+    """
+    Computes the Generalized Advantage Estimation with a Python loop over the time steps.
+
+    This is the plain recursion that compute_gae unrolls, kept as the reference it is tested against.
+    Args and Returns are the same as for compute_gae.
+    """
+    T = len(rewards)
+    advantages = torch.zeros_like(value_preds)
+
+    gae = 0.0
+    for t in reversed(range(T - 1)):
+        td_error = (
+                rewards[t] + gamma * masks[t] * value_preds[t + 1] - value_preds[t]
+        )
+        gae = td_error + gamma * lam * masks[t] * gae
+        advantages[t] = gae
+    return advantages
+
+
 class A2C(nn.Module):
     """
     (Synchronous) Advantage Actor-Critic agent class
 
     Args:
-        n_features: The number of features of the input state.
+        n_features: The number of features of the input state, or of the encoded image if observation_shape is set.
         n_actions: The number of actions the agent can take.
         device: The device to run the computations on (running on a GPU might be quicker for larger Neural Nets,
                 for this code CPU is totally fine).
         critic_lr: The learning rate for the critic network (should usually be larger than the actor_lr).
         actor_lr: The learning rate for the actor network.
         n_envs: The number of environments that run in parallel (on multiple CPUs) to collect experiences.
+        observation_shape: The (height, width, channels) shape of uint8 image observations. If set, a convolutional
+                           encoder shared by the actor and critic maps the images to n_features features.
+        fused: If True, the summed actor and critic loss is backpropagated once and a single RMSprop optimizer
+               with one parameter group per network updates all parameters.
+        max_grad_norm: If set, the gradients are clipped to this norm before the optimizer step.
+        mixed_precision: If True, the forward pass runs under bfloat16 autocast (also on CPU).
     """
 
     def __init__(
@@ -26,11 +121,38 @@ class A2C(nn.Module):
             critic_lr: float,
             actor_lr: float,
             n_envs: int,
+            observation_shape: Optional[tuple[int, int, int]] = None,
+            fused: bool = False,
+            max_grad_norm: Optional[float] = None,
+            mixed_precision: bool = False,
     ) -> None:
         """Initializes the actor and critic networks and their respective optimizers."""
         super().__init__()
         self.device = device
         self.n_envs = n_envs
+        self.fused = fused
+        self.max_grad_norm = max_grad_norm
+        self.mixed_precision = mixed_precision
+        self.encoder = None
+
+        # pinned host buffer the states are staged in for non-blocking transfers to a CUDA device
+        self.staging = None
+        self.staging_event = None
+
+        if observation_shape is not None:
+            height, width, channels = observation_shape
+            conv_layers = [
+                nn.Conv2d(channels, 32, kernel_size=8, stride=4),
+                nn.ReLU(),
+                nn.Conv2d(32, 64, kernel_size=4, stride=2),
+                nn.ReLU(),
+                nn.Conv2d(64, 64, kernel_size=3, stride=1),
+                nn.ReLU(),
+                nn.Flatten(),
+            ]
+            with torch.no_grad():
+                n_conv_features = nn.Sequential(*conv_layers)(torch.zeros(1, channels, height, width)).shape[1]
+            self.encoder = nn.Sequential(*conv_layers, nn.Linear(n_conv_features, n_features), nn.ReLU()).to(self.device)
 
         critic_layers = [
             nn.Linear(n_features, 32),
@@ -54,25 +176,75 @@ class A2C(nn.Module):
         self.critic = nn.Sequential(*critic_layers).to(self.device)
         self.actor = nn.Sequential(*actor_layers).to(self.device)
 
-        # define optimizers for actor and critic
-        self.critic_optim = optim.RMSprop(self.critic.parameters(), lr=critic_lr)
-        self.actor_optim = optim.RMSprop(self.actor.parameters(), lr=actor_lr)
+        # define optimizers for actor and critic, the shared encoder is trained with the critic's learning rate
+        self.critic_params = list(self.critic.parameters())
+        if self.encoder is not None:
+            self.critic_params += list(self.encoder.parameters())
+        self.actor_params = list(self.actor.parameters())
+        if self.fused:
+            self.optim = optim.RMSprop([
+                {"params": self.critic_params, "lr": critic_lr},
+                {"params": self.actor_params, "lr": actor_lr},
+            ])
+        else:
+            self.critic_optim = optim.RMSprop(self.critic_params, lr=critic_lr)
+            self.actor_optim = optim.RMSprop(self.actor_params, lr=actor_lr)
+
+    def __to_device(self, x: np.ndarray | torch.Tensor) -> torch.Tensor:
+        """
+        Moves a batch of states to the device in its own dtype, without a float copy on the host.
+
+        NumPy arrays are wrapped with torch.from_numpy. For a CUDA device they are then copied into a persistent
+        pinned staging buffer and transferred without blocking. Tensors are moved directly, without blocking
+        if they are pinned.
+
+        Args:
+            x: A batch of states as a NumPy array or a tensor.
 
-    def forward(self, x: np.ndarray) -> tuple[torch.Tensor, torch.Tensor]:
+        Returns:
+            x: The batch of states on the device.
+        """
+        if isinstance(x, torch.Tensor):
+            return x.to(self.device, non_blocking=x.is_pinned())
+
+        x = torch.from_numpy(np.ascontiguousarray(x))
+        if self.device.type != "cuda":
+            return x
+
+        if self.staging is None or self.staging.shape != x.shape or self.staging.dtype != x.dtype:
+            self.staging = torch.empty(x.shape, dtype=x.dtype, pin_memory=True)
+        elif self.staging_event is not None:
+            # the previous transfer has to finish reading the buffer before it is overwritten
+            self.staging_event.synchronize()
+        self.staging.copy_(x)
+        x = self.staging.to(self.device, non_blocking=True)
+        self.staging_event = torch.cuda.Event()
+        self.staging_event.record()
+        return x
+
+    def forward(self, x: np.ndarray | torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
         """
         Forward pass of the networks.
 
         Args:
-            x: A batched vector of states.
+            x: A batched vector of states, or a batch of uint8 images with shape [n_envs, height, width, channels]
+               if the agent has an encoder, as a NumPy array or a (pinned) tensor. The states are converted to
+               floats only on the device.
 
         Returns:
             state_values: A tensor with the state values, with shape [n_envs,].
             action_logits_vec: A tensor with the action logits, with shape [n_envs, n_actions].
         """
-        x = torch.Tensor(x).to(self.device)
-        state_values = self.critic(x)  # shape: [n_envs,]
-        action_logits_vec = self.actor(x)  # shape: [n_envs, n_actions]
-        return state_values, action_logits_vec
+        x = self.__to_device(x)
+        with torch.autocast(self.device.type, dtype=torch.bfloat16, enabled=self.mixed_precision):
+            if self.encoder is not None:
+                x = self.encoder(x.permute(0, 3, 1, 2) / 255.0)  # one pass shared by both heads
+            else:
+                x = x.float()
+            state_values = self.critic(x)  # shape: [n_envs,]
+            action_logits_vec = self.actor(x)  # shape: [n_envs, n_actions]
+        # the losses and the action distribution are computed in float32
+        return state_values.float(), action_logits_vec.float()
 
     def select_action(
             self, x: np.ndarray
@@ -128,17 +300,8 @@ class A2C(nn.Module):
             critic_loss: The critic loss for the minibatch.
             actor_loss: The actor loss for the minibatch.
         """
-        T = len(rewards)
-        advantages = torch.zeros(T, self.n_envs, device=device)
-
         # compute the advantages using GAE
-        gae = 0.0
-        for t in reversed(range(T - 1)):
-            td_error = (
-                    rewards[t] + gamma * masks[t] * value_preds[t + 1] - value_preds[t]
-            )
-            gae = td_error + gamma * lam * masks[t] * gae
-            advantages[t] = gae
+        advantages = compute_gae(rewards, value_preds, masks, gamma, lam).to(device)
 
         # calculate the loss of the minibatch for actor and critic
         critic_loss = advantages.pow(2).mean()
@@ -154,15 +317,28 @@ class A2C(nn.Module):
     ) -> None:
         """
         Updates the parameters of the actor and critic networks.
+        Both losses are backpropagated before either optimizer steps, so the gradients of the shared encoder
+        (if any) are the sum of the gradients of both losses. In fused mode this is done by a single backward pass
+        of the summed loss, which gives the same gradients.
 
         Args:
             critic_loss: The critic loss.
             actor_loss: The actor loss.
         """
-        self.critic_optim.zero_grad()
-        critic_loss.backward()
-        self.critic_optim.step()
+        if self.fused:
+            self.optim.zero_grad()
+            (critic_loss + actor_loss).backward()
+            if self.max_grad_norm is not None:
+                nn.utils.clip_grad_norm_(self.parameters(), self.max_grad_norm)
+            self.optim.step()
+            return
 
+        self.critic_optim.zero_grad()
         self.actor_optim.zero_grad()
+        critic_loss.backward(retain_graph=self.encoder is not None)
         actor_loss.backward()
+        if self.max_grad_norm is not None:
+            nn.utils.clip_grad_norm_(self.critic_params, self.max_grad_norm)
+            nn.utils.clip_grad_norm_(self.actor_params, self.max_grad_norm)
+        self.critic_optim.step()
         self.actor_optim.step()
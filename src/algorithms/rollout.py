@@ -0,0 +1,66 @@
+import torch
+
+
+class RolloutStorage:
+    """
+    Preallocated storage for the transitions collected by an A2C agent in one sampling phase.
+
+    Every quantity is kept in one [n_steps_per_update, n_envs] tensor that is written step by step, so the rollout
+    never has to be stacked from Python lists. The log-probs, state values and entropies keep their autograd graph
+    until `reset` is called, which has to happen after the losses of the rollout have been backpropagated.
+
+    Args:
+        n_steps_per_update: The number of time steps collected per update.
+        n_envs: The number of environments that run in parallel.
+        device: The device to store the tensors on.
+    """
+
+    def __init__(self, n_steps_per_update: int, n_envs: int, device: torch.device) -> None:
+        """Allocates the rollout tensors."""
+        self.n_steps_per_update = n_steps_per_update
+        self.n_envs = n_envs
+        self.device = device
+        self.step = 0
+
+        shape = (n_steps_per_update, n_envs)
+        self.rewards = torch.zeros(shape, device=device)
+        self.action_log_probs = torch.zeros(shape, device=device)
+        self.value_preds = torch.zeros(shape, device=device)
+        self.entropy = torch.zeros(shape, device=device)
+        self.masks = torch.zeros(shape, device=device)
+
+    def insert(
+            self,
+            rewards: torch.Tensor,
+            action_log_probs: torch.Tensor,
+            value_preds: torch.Tensor,
+            entropy: torch.Tensor,
+            masks: torch.Tensor,
+    ) -> None:
+        """
+        Writes the transitions of one time step of all environments.
+
+        Args:
+            rewards: A tensor with the rewards, with shape [n_envs,].
+            action_log_probs: A tensor with the log-probs of the taken actions, with shape [n_envs,].
+            value_preds: A tensor with the state value predictions, with shape [n_envs,] or [n_envs, 1].
+            entropy: A tensor with the entropies of the action distributions, with shape [n_envs,].
+            masks: A tensor with zeros for the environments whose episode ended and ones otherwise, with shape [n_envs,].
+        """
+        self.rewards[self.step] = rewards
+        self.action_log_probs[self.step] = action_log_probs
+        self.value_preds[self.step] = value_preds.view(self.n_envs)
+        self.entropy[self.step] = entropy
+        self.masks[self.step] = masks
+        self.step += 1
+
+    def full(self) -> bool:
+        """Returns True when all n_steps_per_update time steps have been written."""
+        return self.step == self.n_steps_per_update
+
+    def reset(self) -> None:
+        """Starts a new rollout, cutting the tensors off the autograd graph of the previous one."""
+        self.step = 0
+        self.action_log_probs.detach_()
+        self.value_preds.detach_()
+        self.entropy.detach_()
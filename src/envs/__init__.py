@@ -1 +1,3 @@
 from .doom_env import ViZDoomEnv
+from .vec_env import ViZDoomVecEnv
+from .profiler import StepProfiler
@@ -1,4 +1,6 @@
+import time
 import warnings
+from collections import deque
 from typing import Optional
 
 import pygame
@@ -6,33 +8,122 @@ import numpy as np
 import gymnasium as gym
 import vizdoom.vizdoom as vzd
 
+from .profiler import StepProfiler, PHASES, MAKE_ACTION, GET_STATE, OBSERVE, RENDER, STEP
+
 OFFSET = 25
 
 
-def colorize_labels(labels: np.ndarray) -> np.ndarray:
-    color_map = np.random.default_rng(3).uniform(low=0, high=255, size=(256, 3)).astype(np.uint8)
-    return color_map[labels]
+LABEL_COLORS = np.random.default_rng(3).uniform(low=0, high=255, size=(256, 3)).astype(np.uint8)
+GRAY_COLORS = np.repeat(np.arange(256, dtype=np.uint8)[:, np.newaxis], 3, axis=1)
+
+
+def colorize_labels(labels: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """ Map a labels buffer to RGB with the fixed `LABEL_COLORS` palette, into `out` if given. """
+    return np.take(LABEL_COLORS, labels, axis=0, out=out)
+
+
+class LazyFrames:
+    """
+    The last k observations of a `ViZDoomEnv` with frame stacking, oldest first. The frames are concatenated along
+    the channel axis only when the stack is converted to an array, e.g. by `np.asarray(observation)`.
+
+    Every frame is its own array that the environment never writes to again, so consecutive stacks share their
+    frames instead of copying them and a stack stays valid after later `step`/`reset` calls.
+    """
+
+    __slots__ = ("frames",)
+
+    def __init__(self, frames: list):
+        """
+        Arguments:
+            frames (list): the k frames of shape (HEIGHT, WIDTH, CHANNELS), oldest first.
+        """
+        self.frames = frames
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, i: int) -> np.ndarray:
+        return self.frames[i]
+
+    def __array__(self, dtype=None, copy=None):
+        observation = np.concatenate(self.frames, axis=-1)
+        return observation if dtype is None else observation.astype(dtype)
+
+    @property
+    def shape(self):
+        return (*self.frames[0].shape[:-1], len(self.frames) * self.frames[0].shape[-1])
+
+    @property
+    def dtype(self):
+        return self.frames[0].dtype
 
 
 class ViZDoomEnv(gym.Env):
     metadata = {
-        "render_modes": ["human", "rgb_array"],
+        "render_modes": ["human", "rgb_array", "rgb_array_mosaic"],
         "render_fps": vzd.DEFAULT_TICRATE,
     }
 
     def __init__(self, config: str,
                  render_fps: int = 1,
-                 render_mode: str = None):
+                 render_mode: str = None,
+                 observation_mode: str = "box",
+                 frame_skip: int = 1,
+                 frame_pooling: Optional[str] = None,
+                 frame_stack: int = 1,
+                 lazy_frames: bool = False,
+                 profile: bool = False,
+                 profile_path: Optional[str] = None,
+                 screen_resolution: Optional[str] = None,
+                 depth_buffer: Optional[bool] = None,
+                 labels_buffer: Optional[bool] = None,
+                 automap_buffer: Optional[bool] = None,
+                 render_scale: int = 1):
         """
         Arguments:
             config (str): path to the config file to load. Most settings should be set by this config file.
             render_fps (int): how many frames should be advanced per action. 1 = take action on every frame. Default: 1.
-            render_mode(Optional[str]): the render mode to use could be either 'human' or 'rgb_array'
+            render_mode(Optional[str]): the render mode to use, one of
+                'human'            - the screen, depth, labels and automap panels are drawn on a pygame window,
+                'rgb_array'        - `render()` returns the screen buffer,
+                'rgb_array_mosaic' - `render()` returns the panels of the 'human' window as an (H, W, 3) uint8 array,
+                                     composed with NumPy without pygame, so it works on headless machines.
+            observation_mode (str): how observations are assembled, one of
+                'box'     - a new (HEIGHT, WIDTH, CHANNELS) array per step, each buffer written into its channels,
+                'inplace' - the same preallocated (HEIGHT, WIDTH, CHANNELS) array is overwritten on every step,
+                            copy it if it has to outlive the next `step`/`reset` call,
+                'dict'    - a dictionary of the buffers themselves, nothing is concatenated.
+                Default: 'box'.
+            frame_skip (int): how many frames the action is repeated for. The engine advances them in a single call,
+                skips the buffers of the intermediate frames, sums the rewards and stops early when the episode ends.
+                Default: 1.
+            frame_pooling (Optional[str]): 'max' or 'mean' combines the screen buffers of the last two skipped frames,
+                so objects flickering between frames are not lost. None keeps only the last frame. Default: None.
+            frame_stack (int): how many of the last observations are stacked along the channel axis. Every frame is
+                assembled once into its own array and the stack is concatenated from the last ones, into the
+                preallocated array in the 'inplace' mode. Not available in the 'dict' observation mode. Default: 1.
+            lazy_frames (bool): with frame stacking, `step`/`reset` return a `LazyFrames` of the last frames instead
+                of concatenating them, so no stack is copied per step. Wrappers that expect an array have to convert
+                it with `np.asarray` first. Default: False.
+            profile (bool): record how long every step spends in `make_action`, `get_state`, observation assembly
+                and rendering. The timings of a step are added to its info as 'timings_ns', `get_profile()` returns
+                their statistics and `close()` reports them. Default: False.
+            profile_path (Optional[str]): with profiling, `close()` writes the statistics to this JSON file instead
+                of printing them. Default: None.
+            screen_resolution (Optional[str]): name of the `ScreenResolution` to render at, e.g. 'RES_160X120',
+                overriding the config file. Default: None (use the config file).
+            depth_buffer, labels_buffer, automap_buffer (Optional[bool]): enable or disable the depth, labels and
+                automap buffers, overriding the config file. Default: None (use the config file).
+            render_scale (int): the 'rgb_array_mosaic' frames are downscaled by this factor, keeping every
+                `render_scale`-th pixel of the buffers. Default: 1.
 
         This environment forces window to be hidden. Use `render()` function to see the game.
 
-        Observations are dictionaries with different amount of entries, depending on if depth/label buffers were
-        enabled in the config file (CHANNELS == 1 if GRAY8, else 3):
+        In the 'box' and 'inplace' modes, the observation holds the screen, depth, labels and automap buffers
+        stacked along the channel axis, depending on if depth/label/automap buffers were enabled in the config
+        file. In the 'dict' mode, observations are dictionaries with different amount of entries
+        (CHANNELS == 1 if GRAY8, else 3):
           "screen"        = the screen image buffer (always available) in shape (HEIGHT, WIDTH, CHANNELS)
           "depth"         = the depth image in shape (HEIGHT, WIDTH, 1), if enabled by the config file,
           "labels"        = the label image buffer in shape (HEIGHT, WIDTH, 1), if enabled by the config file.
@@ -42,14 +133,38 @@ class ViZDoomEnv(gym.Env):
         """
 
         super().__init__()
+        if observation_mode not in ("box", "inplace", "dict"):
+            raise ValueError(f"Unknown observation mode: {observation_mode}")
+        if frame_pooling not in (None, "max", "mean"):
+            raise ValueError(f"Unknown frame pooling: {frame_pooling}")
+        if frame_stack > 1 and observation_mode == "dict":
+            raise ValueError("Frame stacking is not available in the 'dict' observation mode")
+        if render_scale < 1:
+            raise ValueError(f"Render scale has to be a positive integer, got {render_scale}")
+
         self.render_fps = render_fps
-        self.frame_skip = 1
+        self.frame_skip = frame_skip
+        self.frame_pooling = frame_pooling
         self.render_mode = render_mode
+        self.render_scale = render_scale
+        self.observation_mode = observation_mode
+        self.frame_stack = frame_stack
+        self.lazy_frames = lazy_frames
+        self.profiler = StepProfiler() if profile else None
+        self.profile_path = profile_path
 
         # init game
         self.game = vzd.DoomGame()
         self.game.load_config(config)
         self.game.set_window_visible(False)
+        if screen_resolution is not None:
+            self.game.set_screen_resolution(getattr(vzd.ScreenResolution, screen_resolution))
+        if depth_buffer is not None:
+            self.game.set_depth_buffer_enabled(depth_buffer)
+        if labels_buffer is not None:
+            self.game.set_labels_buffer_enabled(labels_buffer)
+        if automap_buffer is not None:
+            self.game.set_automap_buffer_enabled(automap_buffer)
 
         screen_format = self.game.get_screen_format()
         if screen_format not in [vzd.ScreenFormat.RGB24, vzd.ScreenFormat.GRAY8]:
@@ -62,9 +177,15 @@ class ViZDoomEnv(gym.Env):
 
         self.state = None
 
+        self.depth = self.game.is_depth_buffer_enabled()
+        self.labels = self.game.is_labels_buffer_enabled()
+        self.automap = self.game.is_automap_buffer_enabled()
+
         self.clock = None
         self.window = None
         self.window_size = None
+        # (name, surface, position) of the enabled panels, the surfaces are created once and updated in place
+        self.panels = None
 
         if render_mode == "human":
             pygame.init()
@@ -72,13 +193,29 @@ class ViZDoomEnv(gym.Env):
                                 2 * self.game.get_screen_height() + 3 * OFFSET)
             self.window = pygame.display.set_mode(self.window_size)
             self.clock = pygame.time.Clock()
+            self.panels = self.__create_panels()
 
-        self.depth = self.game.is_depth_buffer_enabled()
-        self.labels = self.game.is_labels_buffer_enabled()
-        self.automap = self.game.is_automap_buffer_enabled()
+        # offscreen frame of the 'rgb_array_mosaic' mode and (name, view) of its enabled panels, written in place
+        self.mosaic = None
+        self.mosaic_panels = None
+        if render_mode == "rgb_array_mosaic":
+            self.mosaic, self.mosaic_panels = self.__create_mosaic()
 
         self.observation_space = self.__get_observation_space()
+        self.buffer_channels = self.__get_buffer_channels()
+        self.observation_buffer = None
+        if observation_mode == "inplace":
+            self.observation_buffer = np.zeros(self.observation_space.shape, dtype=np.uint8)
+
+        # the last `frame_stack` observations, oldest first, each in its own array that is never overwritten
+        self.frames = None
+        if frame_stack > 1:
+            self.frames = deque(maxlen=frame_stack)
         self.action_space = gym.spaces.Discrete(self.game.get_available_buttons_size())
+        self.actions = np.eye(self.action_space.n, dtype=np.uint8).tolist()
+
+        # screen buffer combined over the last two frames of a skipped step, see `frame_pooling`
+        self.pooled_screen = None
 
         self.game.init()
 
@@ -86,17 +223,39 @@ class ViZDoomEnv(gym.Env):
         assert self.action_space.contains(action), f"{action} ({type(action)}) invalid"
         assert self.state is not None, "Call `reset` before using `step` method."
 
-        act = np.zeros(self.action_space.n)
-        act[action] = 1
-        act = np.uint8(act)
-        env_action = act.tolist()
-        reward = self.game.make_action(env_action, self.frame_skip)
-        self.state = self.game.get_state()
+        if self.profiler is not None:
+            return self.__profiled_step(action)
+
+        reward = self.__make_action(self.actions[action])
+        terminated = self.game.is_episode_finished()
+
+        if self.render_mode == "human":
+            self.render()
+        return self.__observe(), reward, terminated, False, {}
+
+    def __profiled_step(self, action: int):
+        """ `step` with the time of every phase added to the profiler. """
+        profiler = self.profiler
+        start = time.perf_counter_ns()
+        reward = self.__make_action(self.actions[action])
         terminated = self.game.is_episode_finished()
 
         if self.render_mode == "human":
+            render_start = time.perf_counter_ns()
             self.render()
-        return self.__collect_observations(), reward, terminated, False, {}
+            profiler.add(RENDER, time.perf_counter_ns() - render_start)
+
+        observe_start = time.perf_counter_ns()
+        observation = self.__observe()
+        end = time.perf_counter_ns()
+        profiler.add(OBSERVE, end - observe_start)
+        profiler.add(STEP, end - start)
+        timings = dict(zip(PHASES, profiler.commit()))
+        return observation, reward, terminated, False, {"timings_ns": timings}
+
+    def get_profile(self) -> Optional[dict]:
+        """ Statistics of the profiled steps, see `StepProfiler.summary`. None if profiling is disabled. """
+        return None if self.profiler is None else self.profiler.summary()
 
     def reset(self, seed: int = None, options: list = None):
         super().reset(seed=seed)
@@ -105,135 +264,246 @@ class ViZDoomEnv(gym.Env):
             self.game.set_seed(seed)
         self.game.new_episode()
         self.state = self.game.get_state()
+        self.pooled_screen = None
 
-        return self.__collect_observations(), {}
+        return self.__observe(reset=True), {}
 
     def render(self):
         if self.render_mode == "rgb_array":
             return self.state.screen_buffer
+        elif self.render_mode == "rgb_array_mosaic":
+            return self.__render_mosaic()
         elif self.render_mode == "human":
-            # Transpose image (pygame wants (width, height, channels), we have (height, width, channels))
-            screen, depth, labels, automap = self.__get_human_render_data()
-
-            horiz_split = (self.window_size[0] + OFFSET) // 2
-            vert_split = (self.window_size[1] + OFFSET) // 2
-
-            self.window.blit(pygame.surfarray.make_surface(screen), (OFFSET, OFFSET))
-            self.window.blit(pygame.surfarray.make_surface(depth), (horiz_split, OFFSET))
-            self.window.blit(pygame.surfarray.make_surface(labels), (OFFSET, vert_split))
-            self.window.blit(pygame.surfarray.make_surface(automap), (horiz_split, vert_split))
-
-            pygame.display.update()
+            # there is no state in the terminal step, the last frame stays on the window then
+            if self.state is not None:
+                for name, surface, position in self.panels:
+                    # pygame indexes (width, height), the transposed buffer has the memory layout of the surface
+                    image = getattr(self.state, f"{name}_buffer")
+                    if image.ndim == 2:
+                        pixels = pygame.surfarray.pixels2d(surface)
+                        pixels[...] = image.T
+                    else:
+                        pixels = pygame.surfarray.pixels3d(surface)
+                        pixels[...] = image.transpose((1, 0, 2))
+                    del pixels  # unlock the surface
+                    self.window.blit(surface, position)
 
             pygame.event.pump()
             pygame.display.flip()
             self.clock.tick(self.metadata["render_fps"])
 
     def close(self):
+        if self.profiler is not None and self.profiler.count > 0:
+            if self.profile_path is not None:
+                self.profiler.dump(self.profile_path)
+            else:
+                print(self.profiler.report())
         if self.window is not None:
             pygame.display.quit()
             pygame.quit()
 
-    def __get_human_render_data(self):
-        state = self.state
+    def __create_panels(self) -> list:
+        """
+        Create a surface for each enabled buffer, disabled panels are never drawn. RGB buffers get 24-bit surfaces
+        with the bytes in R, G, B order (on little-endian machines), so copying a buffer in is a plain memory copy.
+        Single channel buffers get 8-bit surfaces whose palette does the colouring when they are blitted, gray for
+        the screen, depth and automap and `LABEL_COLORS` for the labels.
+        """
         w, h = self.game.get_screen_width(), self.game.get_screen_height()
-        screen, depth = state.screen_buffer, np.zeros((h, w, 3))
-        labels, automap = np.zeros((h, w, 3)), np.zeros((h, w, 3))
-
-        if self.game.get_screen_channels() == 1:
-            screen = np.repeat(state.screen_buffer, 3, axis=2)
-        screen = screen.transpose((1, 0, 2))
-
-        if self.depth:
-            depth = np.repeat(state.depth_buffer[..., np.newaxis], 3, axis=2)
-        depth = depth.transpose((1, 0, 2))
-
-        if self.labels:
-            labels = colorize_labels(state.labels_buffer)
-            labels = labels.transpose((1, 0, 2))
+        rgb = self.game.get_screen_channels() == 3
+
+        panels = []
+        for name, position in self.__get_panel_layout(w, h, OFFSET):
+            if rgb and name in ("screen", "automap"):
+                surface = pygame.Surface((w, h), 0, 24, (0xFF, 0xFF00, 0xFF0000, 0))
+            else:
+                surface = pygame.Surface((w, h), 0, 8)
+                surface.set_palette(LABEL_COLORS if name == "labels" else GRAY_COLORS)
+            panels.append((name, surface, position))
+        return panels
+
+    def __create_mosaic(self) -> tuple:
+        """
+        Allocate the 'rgb_array_mosaic' frame with the layout of the 'human' window, scaled down by `render_scale`,
+        and a view of it for each enabled panel. Disabled panels and the margins stay black.
+        """
+        scale = self.render_scale
+        # a strided buffer keeps ceil(size / scale) pixels
+        w = -(-self.game.get_screen_width() // scale)
+        h = -(-self.game.get_screen_height() // scale)
+        offset = OFFSET // scale
+        mosaic = np.zeros((2 * h + 3 * offset, 2 * w + 3 * offset, 3), dtype=np.uint8)
+        panels = [(name, mosaic[y:y + h, x:x + w]) for name, (x, y) in self.__get_panel_layout(w, h, offset)]
+        return mosaic, panels
+
+    def __render_mosaic(self) -> np.ndarray:
+        """ Write the buffers of the current state into their panels of the mosaic and return a copy of it. """
+        # there is no state in the terminal step, the last frame is returned again then
+        if self.state is not None:
+            scale = self.render_scale
+            for name, panel in self.mosaic_panels:
+                image = getattr(self.state, f"{name}_buffer")[::scale, ::scale]
+                if name == "labels":
+                    colorize_labels(image, out=panel)
+                elif image.ndim == 2:
+                    # filling the channels one by one is much faster than broadcasting into the strided view
+                    for channel in range(3):
+                        panel[..., channel] = image
+                else:
+                    panel[...] = image
+        # video recorders keep the frames they are given, so the reused mosaic is not handed out
+        return self.mosaic.copy()
+
+    def __get_panel_layout(self, w: int, h: int, offset: int) -> list:
+        """
+        (name, (x, y)) of the enabled panels of size (w, h) in the 2x2 layout, screen and depth on the top row,
+        labels and automap on the bottom one, separated by `offset` pixels.
+        """
+        horiz_split = w + 2 * offset
+        vert_split = h + 2 * offset
+        layout = [("screen", (offset, offset)), ("depth", (horiz_split, offset)),
+                  ("labels", (offset, vert_split)), ("automap", (horiz_split, vert_split))]
+        enabled = {"screen": True, "depth": self.depth, "labels": self.labels, "automap": self.automap}
+        return [(name, position) for name, position in layout if enabled[name]]
+
+    def __make_action(self, action: list) -> float:
+        """ Repeat the action for `frame_skip` frames, pooling the screens of the last two if enabled. """
+        self.pooled_screen = None
+        if self.frame_pooling is None or self.frame_skip < 2:
+            reward = self.__game_make_action(action, self.frame_skip)
+            self.state = self.__game_get_state()
+            return reward
+
+        reward = self.__game_make_action(action, self.frame_skip - 1)
+        if self.game.is_episode_finished():
+            self.state = None
+            return reward
+        previous_screen = self.__game_get_state().screen_buffer
+        reward += self.__game_make_action(action, 1)
+        self.state = self.__game_get_state()
+        if self.state is None:
+            return reward
+
+        if self.frame_pooling == "max":
+            self.pooled_screen = np.maximum(previous_screen, self.state.screen_buffer)
+        else:
+            pooled = np.add(previous_screen, self.state.screen_buffer, dtype=np.uint16)
+            self.pooled_screen = (pooled >> 1).astype(np.uint8)
+        return reward
+
+    def __game_make_action(self, action: list, tics: int) -> float:
+        if self.profiler is None:
+            return self.game.make_action(action, tics)
+        start = time.perf_counter_ns()
+        reward = self.game.make_action(action, tics)
+        self.profiler.add(MAKE_ACTION, time.perf_counter_ns() - start)
+        return reward
+
+    def __game_get_state(self):
+        if self.profiler is None:
+            return self.game.get_state()
+        start = time.perf_counter_ns()
+        state = self.game.get_state()
+        self.profiler.add(GET_STATE, time.perf_counter_ns() - start)
+        return state
+
+    def __get_buffer(self, name: str) -> np.ndarray:
+        if name == "screen_buffer" and self.pooled_screen is not None:
+            return self.pooled_screen
+        return getattr(self.state, name)
+
+    def __observe(self, reset: bool = False):
+        """ Collect the observation, pushing it to the frame stack if enabled. """
+        if self.frames is None:
+            return self.__collect_observations()
+
+        frame = self.__collect_observations(np.empty(self.frame_shape, dtype=np.uint8))
+        if reset:
+            # the stack of the first observation of an episode is that observation repeated
+            self.frames.extend([frame] * self.frame_stack)
+        else:
+            self.frames.append(frame)
+        if self.lazy_frames:
+            return LazyFrames(list(self.frames))
+        return np.concatenate(self.frames, axis=-1, out=self.observation_buffer)
+
+    def __collect_observations(self, observation: Optional[np.ndarray] = None):
+        """ Create the observation from the screen, depth, labels and automap buffers, if available. """
+        if self.observation_mode == "dict":
+            return self.__collect_dict_observations()
+
+        if observation is None:
+            if self.observation_buffer is not None:
+                observation = self.observation_buffer
+            else:
+                observation = np.empty(self.frame_shape, dtype=np.uint8)
+
+        if self.state is None:
+            # there is no state in the terminal step, so a zero observation is returned instead
+            observation.fill(0)
+            return observation
 
-        if self.automap:
-            automap = state.automap_buffer
-            if self.game.get_screen_channels() == 1:
-                automap = np.repeat(state.automap_buffer, 3, axis=2)
-            automap = automap.transpose((1, 0, 2))
-
-        return screen, depth, labels, automap
-
-    def __add_state_data(self, observation: np.ndarray, data: np.ndarray):
-        """ Reshape the data to the correct shape. If the data is a 2D array,
-        reshape it to a 3D array with a single channel. If the data is a 3D array
-        keep it as it is. Then concatenate the data to the observation array. """
-        if len(data.shape) == 2:
-            data = data[..., np.newaxis]
-        observation = np.concatenate((observation, data), axis=2)
+        for name, channels in self.buffer_channels:
+            data = self.__get_buffer(name)
+            observation[..., channels] = data if data.ndim == 3 else data[..., np.newaxis]
         return observation
 
-    def __collect_observations(self):
-        """ Create a Box space with the observation data by concatenating the
-        screen, depth, labels and automap buffers, if available."""
-
+    def __collect_dict_observations(self):
+        observation = {}
         if self.state is not None:
-            observation = self.state.screen_buffer
+            for name, _ in self.buffer_channels:
+                data = self.__get_buffer(name)
+                observation[name[:-len("_buffer")]] = data if data.ndim == 3 else data[..., np.newaxis]
+            if self.num_game_variables > 0:
+                observation["game_variables"] = self.state.game_variables.astype(np.float32)
+        else:
+            # there is no state in the terminal step, so a zero observation is returned instead
+            for space_key, space_item in self.observation_space.spaces.items():
+                observation[space_key] = np.zeros(space_item.shape, dtype=space_item.dtype)
+        return observation
 
-            if self.depth:
-                observation = self.__add_state_data(observation, self.state.depth_buffer)
-            if self.labels:
-                observation = self.__add_state_data(observation, self.state.labels_buffer)
-            if self.automap:
-                observation = self.__add_state_data(observation, self.state.automap_buffer)
+    def __get_buffer_channels(self):
+        """ Channel slices of the observation occupied by each enabled state buffer, in stacking order. """
+        screen_channels = self.game.get_screen_channels()
+        buffers = [("screen_buffer", screen_channels), ("depth_buffer", self.depth),
+                   ("labels_buffer", self.labels), ("automap_buffer", self.automap * screen_channels)]
 
-            return observation
-        else:
-            return np.zeros(self.observation_space.shape, dtype=np.uint8)
+        buffer_channels, start = [], 0
+        for name, channels in buffers:
+            if channels:
+                buffer_channels.append((name, slice(start, start + channels)))
+                start += channels
+        return buffer_channels
 
     def __get_observation_space(self):
-        channels = self.game.get_screen_channels() + self.depth + self.labels + self.automap * 3
-        shape = (self.game.get_screen_height(), self.game.get_screen_width(), channels)
+        if self.observation_mode == "dict":
+            return self.__get_dict_observation_space()
+
+        channels = self.game.get_screen_channels() * (1 + self.automap) + self.depth + self.labels
+        self.frame_shape = (self.game.get_screen_height(), self.game.get_screen_width(), channels)
+        shape = (*self.frame_shape[:2], channels * self.frame_stack)
         return gym.spaces.Box(low=0, high=255, shape=shape, dtype=np.uint8)
 
-    # def __collect_observations(self):
-    #     observation = {}
-    #     if self.state is not None:
-    #         observation["screen"] = self.state.screen_buffer
-    #         if self.game.get_screen_channels() == 1:
-    #             observation["screen"] = self.state.screen_buffer[..., np.newaxis]
-    #         if self.depth:
-    #             observation["depth"] = self.state.depth_buffer[..., np.newaxis]
-    #         if self.labels:
-    #             observation["labels"] = self.state.labels_buffer[..., np.newaxis]
-    #         if self.automap:
-    #             observation["automap"] = self.state.automap_buffer
-    #             if self.game.get_screen_channels() == 1:
-    #                 observation["automap"] = self.state.automap_buffer[..., np.newaxis]
-    #         if self.num_game_variables > 0:
-    #             observation["game_variables"] = self.state.game_variables.astype(np.float32)
-    #     else:
-    #         # there is no state in the terminal step, so a zero observation is returned instead
-    #         for space_key, space_item in self.observation_space.spaces.items():
-    #             observation[space_key] = np.zeros(space_item.shape, dtype=space_item.dtype)
-    #     return observation
-    #
-    # def __get_observation_space(self):
-    #     scalar_shape = (self.game.get_screen_height(), self.game.get_screen_width(), 1)
-    #     channel_shape = (self.game.get_screen_height(), self.game.get_screen_width(), self.game.get_screen_channels())
-    #
-    #     spaces = {"screen": gym.spaces.Box(0, 255, channel_shape, dtype=np.uint8)}
-    #
-    #     if self.depth:
-    #         spaces["depth"] = gym.spaces.Box(0, 255, scalar_shape, dtype=np.uint8)
-    #     if self.labels:
-    #         spaces["labels"] = gym.spaces.Box(0, 255, scalar_shape, dtype=np.uint8)
-    #     if self.automap:
-    #         spaces["automap"] = gym.spaces.Box(0, 255, channel_shape, dtype=np.uint8)
-    #
-    #     self.num_game_variables = self.game.get_available_game_variables_size()
-    #     if self.num_game_variables > 0:
-    #         spaces["game_variables"] = gym.spaces.Box(
-    #             np.finfo(np.float32).min,
-    #             np.finfo(np.float32).max,
-    #             (self.num_game_variables,),
-    #             dtype=np.float32,
-    #         )
-    #
-    #     return gym.spaces.Dict(spaces)
+    def __get_dict_observation_space(self):
+        scalar_shape = (self.game.get_screen_height(), self.game.get_screen_width(), 1)
+        channel_shape = (self.game.get_screen_height(), self.game.get_screen_width(), self.game.get_screen_channels())
+
+        spaces = {"screen": gym.spaces.Box(0, 255, channel_shape, dtype=np.uint8)}
+
+        if self.depth:
+            spaces["depth"] = gym.spaces.Box(0, 255, scalar_shape, dtype=np.uint8)
+        if self.labels:
+            spaces["labels"] = gym.spaces.Box(0, 255, scalar_shape, dtype=np.uint8)
+        if self.automap:
+            spaces["automap"] = gym.spaces.Box(0, 255, channel_shape, dtype=np.uint8)
+
+        self.num_game_variables = self.game.get_available_game_variables_size()
+        if self.num_game_variables > 0:
+            spaces["game_variables"] = gym.spaces.Box(
+                np.finfo(np.float32).min,
+                np.finfo(np.float32).max,
+                (self.num_game_variables,),
+                dtype=np.float32,
+            )
+
+        return gym.spaces.Dict(spaces)
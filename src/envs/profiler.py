@@ -0,0 +1,82 @@
+import json
+from typing import List
+
+import numpy as np
+
+PHASES = ("make_action", "get_state", "observe", "render", "step")
+MAKE_ACTION, GET_STATE, OBSERVE, RENDER, STEP = range(len(PHASES))
+
+
+class StepProfiler:
+    """
+    Per-phase timings of `ViZDoomEnv.step`, recorded with `time.perf_counter_ns`.
+
+    The time spent in each phase is summed over one step in a small list and written to a preallocated
+    (PHASES, capacity) int64 array when the step is committed. The array is a circular buffer, so the summaries
+    describe the last `capacity` steps while `count` keeps the total number of profiled steps.
+    """
+
+    def __init__(self, capacity: int = 10000):
+        """
+        Arguments:
+            capacity (int): how many of the most recent steps are kept. Default: 10000.
+        """
+        self.capacity = capacity
+        self.samples = np.zeros((len(PHASES), capacity), dtype=np.int64)
+        self.current = [0] * len(PHASES)
+        self.count = 0
+
+    def add(self, phase: int, duration: int):
+        """ Add `duration` nanoseconds to `phase` of the current step. """
+        self.current[phase] += duration
+
+    def commit(self) -> List[int]:
+        """ Store the timings of the current step and start the next one. Returns the stored timings. """
+        timings = self.current
+        self.samples[:, self.count % self.capacity] = timings
+        self.current = [0] * len(PHASES)
+        self.count += 1
+        return timings
+
+    def summary(self) -> dict:
+        """
+        Statistics of every phase over the recorded steps, in microseconds: mean, percentiles, maximum, the share
+        of the step time and a histogram of power-of-two buckets ('<=1', '<=2', '<=4', ... microseconds).
+        """
+        samples = self.samples[:, :min(self.count, self.capacity)] / 1000
+        summary = {"steps": self.count, "recorded": samples.shape[1], "phases": {}}
+        if samples.shape[1] == 0:
+            return summary
+
+        step_total = samples[STEP].sum()
+        for phase, name in enumerate(PHASES):
+            durations = samples[phase]
+            buckets = np.ceil(np.log2(np.maximum(durations, 1))).astype(np.int64)
+            histogram = np.bincount(buckets)
+            p50, p90, p99 = np.percentile(durations, (50, 90, 99))
+            summary["phases"][name] = {
+                "mean_us": float(durations.mean()),
+                "p50_us": float(p50),
+                "p90_us": float(p90),
+                "p99_us": float(p99),
+                "max_us": float(durations.max()),
+                "share": float(durations.sum() / step_total) if step_total > 0 else 0.0,
+                "histogram_us": {f"<={2 ** i}": int(n) for i, n in enumerate(histogram) if n > 0},
+            }
+        return summary
+
+    def report(self) -> str:
+        """ A human readable table of `summary`. """
+        summary = self.summary()
+        lines = [f"ViZDoomEnv step profile, {summary['recorded']} of {summary['steps']} steps recorded"]
+        if summary["phases"]:
+            lines.append(f"{'phase':<12}{'mean us':>10}{'p50 us':>10}{'p99 us':>10}{'max us':>10}{'share':>8}")
+            for name, stats in summary["phases"].items():
+                lines.append(f"{name:<12}{stats['mean_us']:>10.1f}{stats['p50_us']:>10.1f}{stats['p99_us']:>10.1f}"
+                             f"{stats['max_us']:>10.1f}{stats['share']:>8.1%}")
+        return "\n".join(lines)
+
+    def dump(self, path: str):
+        """ Write `summary` to a JSON file. """
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
@@ -0,0 +1,156 @@
+import multiprocessing as mp
+from multiprocessing.shared_memory import SharedMemory
+from typing import Callable, List, Optional
+
+import numpy as np
+import gymnasium as gym
+from stable_baselines3.common.env_util import is_wrapped
+from stable_baselines3.common.vec_env import SubprocVecEnv
+from stable_baselines3.common.vec_env.base_vec_env import CloudpickleWrapper, VecEnv, VecEnvObs, VecEnvStepReturn
+
+
+def _worker(remote, parent_remote, env_fn_wrapper: CloudpickleWrapper, index: int):
+    parent_remote.close()
+    env = env_fn_wrapper.var()
+    shared_memory, observations = None, None
+    while True:
+        try:
+            cmd, data = remote.recv()
+            if cmd == "step":
+                observation, reward, terminated, truncated, info = env.step(data)
+                done = terminated or truncated
+                info["TimeLimit.truncated"] = truncated and not terminated
+                reset_info = None
+                if done:
+                    # the final observation has to survive the reset, so it is the only frame sent through the pipe
+                    info["terminal_observation"] = np.array(observation)
+                    observation, reset_info = env.reset()
+                observations[index] = observation
+                remote.send((reward, done, info, reset_info))
+            elif cmd == "reset":
+                maybe_options = {"options": data[1]} if data[1] else {}
+                observation, reset_info = env.reset(seed=data[0], **maybe_options)
+                observations[index] = observation
+                remote.send(reset_info)
+            elif cmd == "attach":
+                shared_memory = SharedMemory(name=data[0])
+                observations = np.ndarray(data[1], dtype=np.uint8, buffer=shared_memory.buf)
+                remote.send(None)
+            elif cmd == "render":
+                remote.send(env.render())
+            elif cmd == "close":
+                env.close()
+                if shared_memory is not None:
+                    del observations
+                    shared_memory.close()
+                remote.close()
+                break
+            elif cmd == "get_spaces":
+                remote.send((env.observation_space, env.action_space))
+            elif cmd == "env_method":
+                method = env.get_wrapper_attr(data[0])
+                remote.send(method(*data[1], **data[2]))
+            elif cmd == "get_attr":
+                remote.send(env.get_wrapper_attr(data))
+            elif cmd == "has_attr":
+                try:
+                    env.get_wrapper_attr(data)
+                    remote.send(True)
+                except AttributeError:
+                    remote.send(False)
+            elif cmd == "set_attr":
+                remote.send(setattr(env, data[0], data[1]))
+            elif cmd == "is_wrapped":
+                remote.send(is_wrapped(env, data))
+            else:
+                raise NotImplementedError(f"`{cmd}` is not implemented in the worker")
+        except (EOFError, KeyboardInterrupt):
+            break
+
+
+class ViZDoomVecEnv(SubprocVecEnv):
+    """
+    Multiprocess vectorized environment for `ViZDoomEnv` with observations in shared memory.
+
+    Every environment runs in its own process, like in `SubprocVecEnv`, but the workers write their observations
+    straight into one shared (n_envs, HEIGHT, WIDTH, CHANNELS) uint8 array. A step only sends the actions one way
+    and the rewards, done flags and infos back over the pipes, frames are never pickled (except for the terminal
+    observation of a finished episode).
+    """
+
+    def __init__(self, env_fns: List[Callable[[], gym.Env]],
+                 start_method: Optional[str] = None,
+                 copy_observations: bool = True):
+        """
+        Arguments:
+            env_fns (List[Callable[[], gym.Env]]): functions creating the (wrapped) environments to run.
+            start_method (Optional[str]): multiprocessing start method, 'forkserver' if available, else 'spawn'.
+            copy_observations (bool): return a copy of the shared observation array from `reset` and `step`.
+                Without the copy, the returned array is overwritten by the next `step`, which breaks algorithms that
+                keep the previous observation around (e.g. Stable-Baselines3's PPO). Default: True.
+        """
+        self.waiting = False
+        self.closed = False
+        self.copy_observations = copy_observations
+        n_envs = len(env_fns)
+
+        if start_method is None:
+            start_method = "forkserver" if "forkserver" in mp.get_all_start_methods() else "spawn"
+        ctx = mp.get_context(start_method)
+
+        self.remotes, self.work_remotes = zip(*[ctx.Pipe() for _ in range(n_envs)])
+        self.processes = []
+        for index, (work_remote, remote, env_fn) in enumerate(zip(self.work_remotes, self.remotes, env_fns)):
+            args = (work_remote, remote, CloudpickleWrapper(env_fn), index)
+            # daemon=True: if the main process crashes, we should not cause things to hang
+            process = ctx.Process(target=_worker, args=args, daemon=True)
+            process.start()
+            self.processes.append(process)
+            work_remote.close()
+
+        self.remotes[0].send(("get_spaces", None))
+        observation_space, action_space = self.remotes[0].recv()
+        if not isinstance(observation_space, gym.spaces.Box) or observation_space.dtype != np.uint8:
+            self.close()
+            raise ValueError(f"Only uint8 Box observations can be shared, got {observation_space}")
+
+        shape = (n_envs, *observation_space.shape)
+        self.shared_memory = SharedMemory(create=True, size=max(int(np.prod(shape)), 1))
+        self.observations = np.ndarray(shape, dtype=np.uint8, buffer=self.shared_memory.buf)
+        for remote in self.remotes:
+            remote.send(("attach", (self.shared_memory.name, shape)))
+        for remote in self.remotes:
+            remote.recv()
+
+        VecEnv.__init__(self, n_envs, observation_space, action_space)
+
+    def __get_observations(self) -> np.ndarray:
+        return self.observations.copy() if self.copy_observations else self.observations
+
+    def step_wait(self) -> VecEnvStepReturn:
+        results = [remote.recv() for remote in self.remotes]
+        self.waiting = False
+        rewards, dones, infos, reset_infos = zip(*results)
+        for env_idx, reset_info in enumerate(reset_infos):
+            if reset_info is not None:
+                self.reset_infos[env_idx] = reset_info
+        return self.__get_observations(), np.array(rewards, dtype=np.float32), np.array(dones), infos
+
+    def reset(self) -> VecEnvObs:
+        for env_idx, remote in enumerate(self.remotes):
+            remote.send(("reset", (self._seeds[env_idx], self._options[env_idx])))
+        self.reset_infos = [remote.recv() for remote in self.remotes]
+        # Seeds and options are only used once
+        self._reset_seeds()
+        self._reset_options()
+        return self.__get_observations()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        super().close()
+        if getattr(self, "shared_memory", None) is not None:
+            del self.observations
+            self.shared_memory.close()
+            self.shared_memory.unlink()
+            self.shared_memory = None
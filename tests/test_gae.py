@@ -0,0 +1,52 @@
+import pytest
+import torch
+
+from src.algorithms.a2c import compute_gae, compute_gae_reference
+
+GAMMA = 0.99
+LAM = 0.95
+
+
+def make_rollout(n_steps, n_envs, seed):
+    generator = torch.Generator().manual_seed(seed)
+    rewards = torch.randn(n_steps, n_envs, generator=generator, dtype=torch.float64, requires_grad=True)
+    value_preds = torch.randn(n_steps, n_envs, generator=generator, dtype=torch.float64, requires_grad=True)
+    # about one in ten steps ends an episode
+    masks = (torch.rand(n_steps, n_envs, generator=generator) > 0.1).double()
+    return rewards, value_preds, masks
+
+
+@pytest.mark.parametrize("n_steps", [1, 2, 3, 16, 17, 33, 512])
+@pytest.mark.parametrize("n_envs", [1, 8, 64])
+def test_compute_gae_matches_loop(n_steps, n_envs):
+    rewards, value_preds, masks = make_rollout(n_steps, n_envs, seed=n_steps * 100 + n_envs)
+    advantages = compute_gae(rewards, value_preds, masks, GAMMA, LAM)
+    expected = compute_gae_reference(rewards, value_preds, masks, GAMMA, LAM)
+    torch.testing.assert_close(advantages, expected, rtol=0, atol=1e-12)
+    if n_steps == 1:
+        # the only advantage is the zero of the last step, which does not depend on the rollout
+        return
+
+    # the same upstream gradient has to give the same gradients of the rewards and value predictions
+    upstream = torch.randn_like(expected)
+    gradients = torch.autograd.grad((advantages * upstream).sum(), (rewards, value_preds))
+    expected_gradients = torch.autograd.grad((expected * upstream).sum(), (rewards, value_preds))
+    for gradient, expected_gradient in zip(gradients, expected_gradients):
+        torch.testing.assert_close(gradient, expected_gradient, rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 4, 16, 64])
+def test_compute_gae_chunk_size(chunk_size):
+    rewards, value_preds, masks = make_rollout(50, 4, seed=chunk_size)
+    advantages = compute_gae(rewards, value_preds, masks, GAMMA, LAM, chunk_size=chunk_size)
+    expected = compute_gae_reference(rewards, value_preds, masks, GAMMA, LAM)
+    torch.testing.assert_close(advantages, expected, rtol=0, atol=1e-12)
+
+
+def test_compute_gae_all_masks_zero():
+    rewards, value_preds, _ = make_rollout(20, 3, seed=0)
+    masks = torch.zeros_like(rewards)
+    advantages = compute_gae(rewards, value_preds, masks, GAMMA, LAM)
+    # without continuing episodes every advantage is the one-step reward minus the value
+    torch.testing.assert_close(advantages[:-1], (rewards - value_preds)[:-1])
+    assert not advantages[-1].any()
@@ -0,0 +1,84 @@
+import time
+from collections import deque
+
+import numpy as np
+import torch
+from stable_baselines3.common.env_util import make_vec_env
+
+import src
+from basic import wrap_env
+from src.envs import ViZDoomVecEnv
+from src.algorithms import A2C, RolloutStorage
+
+ENV_NAME = "ViZDoomBasic-v0"
+MODEL_PATH = "a2c_vizdoom_basic.pth"
+N_ENVS = 8
+N_UPDATES = 1000
+N_STEPS_PER_UPDATE = 32
+FRAME_SKIP = 4
+N_FEATURES = 256
+
+GAMMA = 0.99
+LAM = 0.95
+ENT_COEF = 0.01
+CRITIC_LR = 5e-4
+ACTOR_LR = 1e-4
+MAX_GRAD_NORM = 0.5
+FUSED_UPDATE = True
+MIXED_PRECISION = False
+LOG_INTERVAL = 10
+
+DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def train(agent, envs, storage, n_updates):
+    observations = envs.reset()
+    episode_returns = np.zeros(envs.num_envs)
+    finished_returns = deque(maxlen=100)
+
+    log_start = time.perf_counter()
+    for update in range(1, n_updates + 1):
+        storage.reset()
+        while not storage.full():
+            actions, action_log_probs, state_values, entropy = agent.select_action(
+                observations)
+            observations, rewards, dones, _ = envs.step(actions.cpu().numpy())
+            storage.insert(torch.from_numpy(rewards), action_log_probs, state_values, entropy,
+                           torch.from_numpy(~dones))
+
+            episode_returns += rewards
+            finished_returns.extend(episode_returns[dones])
+            episode_returns[dones] = 0
+
+        critic_loss, actor_loss = agent.get_losses(storage.rewards, storage.action_log_probs, storage.value_preds,
+                                                   storage.entropy, storage.masks, GAMMA, LAM, ENT_COEF, DEVICE)
+        agent.update_parameters(critic_loss, actor_loss)
+
+        if update % LOG_INTERVAL == 0:
+            elapsed = time.perf_counter() - log_start
+            env_steps = LOG_INTERVAL * storage.n_steps_per_update * envs.num_envs
+            mean_return = np.mean(finished_returns) if finished_returns else float("nan")
+            print(f"Update {update}: critic loss {critic_loss.item():.4f}, actor loss {actor_loss.item():.4f}, "
+                  f"mean return {mean_return:.1f}, {env_steps / elapsed:.0f} env-steps/s, "
+                  f"{LOG_INTERVAL / elapsed:.2f} updates/s")
+            log_start = time.perf_counter()
+
+
+def main():
+    # the observations are turned into tensors before the next step, so the shared array does not have to be copied
+    envs = make_vec_env(ENV_NAME, n_envs=N_ENVS, wrapper_class=wrap_env,
+                        env_kwargs={"frame_skip": FRAME_SKIP},
+                        vec_env_cls=ViZDoomVecEnv, vec_env_kwargs={"copy_observations": False})
+
+    agent = A2C(N_FEATURES, envs.action_space.n, DEVICE, CRITIC_LR, ACTOR_LR, N_ENVS,
+                observation_shape=envs.observation_space.shape, fused=FUSED_UPDATE, max_grad_norm=MAX_GRAD_NORM,
+                mixed_precision=MIXED_PRECISION)
+    storage = RolloutStorage(N_STEPS_PER_UPDATE, N_ENVS, DEVICE)
+
+    train(agent, envs, storage, N_UPDATES)
+    torch.save(agent.state_dict(), MODEL_PATH)
+    envs.close()
+
+
+if __name__ == "__main__":
+    main()